@@ -1,18 +1,26 @@
-import os
-from typing import List, Callable, Union, Dict, Any
+import asyncio
+import sys
+from typing import List, Union, Dict, Any, Optional, Tuple
 
 from pymake.builderrors import BuildError
 
 
 class BaseRule:
+    # Slotted, as builds can have hundreds of thousands of rules. For the same reason names are
+    # interned, so a name and every prerequisite naming it share one string, and the settings and
+    # resources, which most rules do not have, take no space of their own until they are added.
+    __slots__ = ('names', 'prerequisites', 'settings', 'force_rebuild', 'executor', 'resources')
+
     def __init__(self, names):
         assert len(names) >= 1, "At least one target must be specified."
 
-        self.names = names
+        self.names = [sys.intern(name) for name in names]
         self.prerequisites: List[str] = []
-        self.settings: List[str] = []
+        self.settings: Tuple[str, ...] = ()
 
         self.force_rebuild = False
+        self.executor = 'thread'
+        self.resources: Optional[Dict[str, float]] = None
 
     def __str__(self) -> str:
         if len(self.prerequisites) == 0:
@@ -32,15 +40,32 @@ class BaseRule:
     def forceRebuild(self):
         return self.force_rebuild
 
+    def setExecutor(self, executor: str) -> None:
+        # 'thread', 'process' or the name of an executor added with Build.addExecutor.
+        self.executor = executor
+
+    def getExecutor(self) -> str:
+        return self.executor
+
+    def setResource(self, name: str, amount: float) -> None:
+        if self.resources is None:
+            self.resources = {}
+        self.resources[name] = amount
+
+    def getResources(self) -> Dict[str, float]:
+        if self.resources is None:
+            return {}
+        return self.resources
+
     def addSetting(self, setting: str) -> None:
-        self.settings.append(setting)
+        self.settings = self.settings + (setting,)
 
-    def getSettings(self) -> List[str]:
+    def getSettings(self) -> Tuple[str, ...]:
         return self.settings
 
     def addPrerequisite(self, prerequisite: Union["BaseRule", str]) -> None:
         if isinstance(prerequisite, str):
-            self.prerequisites.append(prerequisite)
+            self.prerequisites.append(sys.intern(prerequisite))
         else:
             self.prerequisites.extend(prerequisite.names)
 
@@ -53,6 +78,19 @@ class BaseRule:
     def getLastBuildTime(self) -> int:
         return -1
 
-    def build(self, settings_values: Dict[str, Any]) -> None:
+    def getContentHash(self, hash_cache: Any) -> Optional[str]:
+        return None
+
+    def getCacheKey(self, settings_values: Dict[str, Any], input_hashes: Dict[str, Optional[str]]) -> Optional[str]:
+        # input_hashes has the content hash of each prerequisite, and of each file the last build of
+        # the rule read beyond them, or None for one that cannot be hashed.
+        return None
+
+    def build(self, settings_values: Dict[str, Any]) -> Optional[List[str]]:
+        # May return the files the rule read, beyond its prerequisites, to be used as dependencies
+        # on the next build.
         raise BuildError("Cannot build %s." % str(self))
 
+    async def buildAsync(self, settings_values: Dict[str, Any]) -> Optional[List[str]]:
+        # Synchronous rules run in a thread so that they do not block the event loop.
+        return await asyncio.to_thread(self.build, settings_values)
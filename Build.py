@@ -1,23 +1,117 @@
+from array import array
+import asyncio
+import contextvars
+import functools
+import heapq
+import inspect
+import json
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import List, Dict, Any, Tuple, Callable, Optional, Union
+import os
+import threading
+import time
+from typing import List, Dict, Any, Tuple, Callable, Optional, Set, Union
+from xml.sax.saxutils import escape
 
 from pymake.BaseRule import BaseRule
-from pymake.builderrors import DuplicateRuleError, NoRuleError, CyclicGraphError, NoSettingError
+from pymake.BuildJournal import BuildJournal
+from pymake.BuildGraph import BuildGraph, BuildTreeView, NodeSetView, Reason
+from pymake.BuildGraph import DISCOVERED_MISSING, PREREQUISITES_CHANGED, SETTINGS_CHANGED, NEWER_SETTING, NEWER_PREREQUISITE, PREREQUISITE_REBUILT
+from pymake.BuildGraph import FORCED_REASON, INTERRUPTED_REASON, MISSING_OUTPUT_REASON
+from pymake.BuildState import BuildState
+from pymake.PatternRule import PatternIndex, PatternRule
+from pymake.builderrors import BuildError, DuplicateRuleError, CyclicGraphError, NoSettingError
 from pymake.Settings import Settings
+from pymake.filerules import DirectoryRule, FileExistsRule
+from pymake.filestat import StatCache, active_stat_cache
+from pymake.filehash import FileHashCache
+from pymake.watcher import createWatcher
 
 Rule = Any
 
+def _usingStatCache(method: Callable) -> Callable:
+    # Makes the build's stat cache the active one while the method runs, see filestat.
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def asyncWrapper(self, *args, **kwargs):
+            token = active_stat_cache.set(self.stat_cache)
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                active_stat_cache.reset(token)
+        return asyncWrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        token = active_stat_cache.set(self.stat_cache)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            active_stat_cache.reset(token)
+    return wrapper
+
+PENDING = 0
+BUILT = 1
+FAILED = 2
+
+def _runRule(rule: BaseRule, settings_values: Dict[str, Any]) -> Tuple[datetime, datetime, float, str, Optional[List[str]]]:
+    # Module level so that it can be sent to a process pool along with the rule.
+    start_time = datetime.now()
+    start_cpu_time = time.thread_time()
+    discovered = rule.build(settings_values)
+    cpu_time = time.thread_time() - start_cpu_time
+    end_time = datetime.now()
+    return (start_time, end_time, cpu_time, '%s:%s' % (os.getpid(), threading.current_thread().name), discovered)
+
 class Build:
     def __init__(self):
         self.print_build = False
         self.colour_print_build = False
         self.rules = {}
+        self.pattern_rules = PatternIndex()
         self.settings = Settings()
         self.trace = []
-        self.build_tree = {}
-        self.built_rules = set()
+        self.graph = BuildGraph()
+        self.build_tree = BuildTreeView(self.graph)
+        self.status = bytearray()
+        self.built_rules = NodeSetView(self.graph, self.status, BUILT)
+        self.failed_rules = set()
+        self.skipped_rules = []
+        self.dependant_offsets = array('q')
+        self.dependant_ids = array('i')
+        self.pending_counts = array('i')
+        self.ready_queue = []
+        self.ready_count = 0
+        self.priorities = array('d')
+        self.durations = {}
+        # rule name -> the dependencies its last build reported reading
+        self.discovered = {}
+        self.executors = {}
+        self.resource_capacity = {}
+        self.resources_in_use = {}
+        # resource name -> amount -> heap of the ready queue entries of rules waiting for it
+        self.waiting = {}
+        self.timings = []
         self.dot_file_name = None
         self.dot_rename_func = None
+        self.dot_dirty_only = False
+        self.dot_targets = None
+        self.dot_hops = None
+        self.dot_critical_path = False
+        self.dot_format = None
+        self.state = None
+        self.trust_recorded_outputs = False
+        self.use_content_hashes = False
+        self.early_cutoff = False
+        self.journal = None
+        self.previous_outputs = {}
+        self.output_changed = bytearray()
+        self.prefetch_stats = False
+        self.artifact_cache = None
+        self.profiler = None
+        self.file_hashes = FileHashCache()
+        self.stat_cache = StatCache()
+        self.prefetch_threads = 1
 
     def _print(self, colour, *strings): 
         if not self.print_build:
@@ -42,8 +136,113 @@ class Build:
     def loadSettings(self, filename: str) -> None:
         self.settings.deserialise(filename)
 
-    def saveSettings(self, filename: str) -> None:
-        self.settings.serialise(filename)
+    def saveSettings(self, filename: str, binary: bool = False) -> None:
+        self.settings.serialise(filename, binary)
+
+    def setStateFile(self, filename: str, trust_recorded_outputs: bool = False, use_content_hashes: bool = False, early_cutoff: bool = False) -> None:
+        # When trusting recorded outputs, targets with prerequisites take their build time from the
+        # state file instead of the file system, so only the sources are checked on a no-op build.
+        # Their outputs are not stat'ed, so one that is deleted is only rebuilt if the stat cache
+        # already knows it is missing, as it does with setStatPrefetch.
+        # With content hashes, a prerequisite that is newer than its dependant only causes a rebuild
+        # if its content differs from when the dependant was last built.
+        # With early cutoff, a rule whose prerequisites were rebuilt with identical output is skipped.
+        # It needs content hashes, so the skipped rule is not out of date on the next build.
+        if self.state is not None:
+            self.state.close()
+        self.state = BuildState(filename)
+        self.trust_recorded_outputs = trust_recorded_outputs
+        self.use_content_hashes = use_content_hashes or early_cutoff
+        self.early_cutoff = early_cutoff
+
+    def _inputChanged(self, node: int, dep: int) -> bool:
+        if not self.use_content_hashes:
+            return True
+        recorded_hash = self.state.getInputHashes(self.graph.getName(node)).get(self.graph.getName(dep))
+        if recorded_hash is None:
+            return True
+        return recorded_hash != self.graph.rules[dep].getContentHash(self.state.file_hashes)
+
+    def setJournal(self, filename: str, sync: bool = False) -> None:
+        # Logs each rule as it starts and finishes, so that a build that is killed can be resumed.
+        # With sync every entry is flushed to disk, which also survives the machine going down.
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = BuildJournal(filename, sync)
+
+    def addExecutor(self, name: str, executor: Executor) -> None:
+        # Makes a concurrent.futures executor available to rules by name, see BaseRule.setExecutor.
+        # It is only used by parallel builds, and is not shut down by the build.
+        assert name not in ('thread', 'process'), "%s is a built in executor." % name
+        self.executors[name] = executor
+
+    def setResourceCapacity(self, name: str, capacity: float) -> None:
+        # Parallel builds only start a rule when its resources fit in what the running rules leave
+        # free. Resources without a capacity are not limited.
+        self.resource_capacity[name] = capacity
+
+    def setProfiler(self, profiler: Any) -> None:
+        self.profiler = profiler
+
+    def getCriticalPath(self) -> Tuple[List[str], float]:
+        if self.profiler is None:
+            raise BuildError("A profiler must be set to find the critical path.")
+        return self.profiler.criticalPath(self.graph)
+
+    def explain(self, name: str) -> Optional[Reason]:
+        # Why the last build needed to build name, or None if it was up to date.
+        if name not in self.build_tree:
+            raise KeyError(name)
+        return self.graph.reasons.get(self.graph.ids[name])
+
+    def explainChain(self, name: str) -> List[Tuple[str, Reason]]:
+        # The rules name needed building because of, following rebuilt prerequisites back to the
+        # rule that needed building for a reason of its own.
+        chain = []
+        reason = self.explain(name)
+        while reason is not None:
+            chain.append((name, reason))
+            if reason.kind != PREREQUISITE_REBUILT:
+                break
+            name = reason.name
+            reason = self.explain(name)
+        return chain
+
+    def explainReport(self) -> str:
+        # One line for every rule the last build needed to build, with the root cause of the rules
+        # that only needed building because a prerequisite did.
+        lines = []
+        for node in self.graph.enteredNodes():
+            if node not in self.graph.reasons:
+                continue
+            chain = self.explainChain(self.graph.getName(node))
+            line = '%s: %s' % chain[0]
+            if len(chain) > 1:
+                line += ', because %s: %s' % chain[-1]
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def setArtifactCache(self, artifact_cache: Any) -> None:
+        # Rules that give a cache key have their outputs restored from the cache instead of being built.
+        self.artifact_cache = artifact_cache
+
+    def _getCacheKey(self, rule: Rule, settings_values: Dict[str, Any]) -> Optional[str]:
+        if self.artifact_cache is None:
+            return None
+        hash_cache = self.state.file_hashes if self.state is not None else self.file_hashes
+        # Each input is hashed by the rule that makes it, so that a directory is hashed by its files.
+        # A discovered dependency that has gone has no node, and no hash.
+        input_hashes = {}
+        for name in rule.getPrerequisites() + self._getDiscovered().get(rule.names[0], []):
+            node = self.graph.ids.get(name)
+            input_hashes[name] = None if node is None else self.graph.rules[node].getContentHash(hash_cache)
+        return rule.getCacheKey(settings_values, input_hashes)
+
+    def setStatPrefetch(self, enabled: bool, threads: int = 1) -> None:
+        # Stats every target reachable from the build target up front, one directory listing at a
+        # time. More than one thread helps on network file systems where each stat is slow.
+        self.prefetch_stats = enabled
+        self.prefetch_threads = threads
 
     def createRule(self, names: Union[str, List[str]], rule_type = BaseRule) -> Rule:
         if type(names) == str:
@@ -57,181 +256,973 @@ class Build:
 
         return new_rule
 
-    def setDotGraphOptions(self, file_name: str, rename_func: Optional[Callable[[str], str]] = None ) -> None:
-        self.dot_file_name = file_name
-        self.dot_rename_func = rename_func
+    def createPatternRule(self, patterns: Union[str, List[str]], rule_type = BaseRule, configure: Optional[Callable[[Rule, str], None]] = None) -> PatternRule:
+        # Rules for the targets matching the patterns are only created when the graph walk reaches them.
+        if type(patterns) == str:
+            patterns = [str(patterns)]
 
-    
-    def _computeBuildSubGraph(self, target: str, build_path: List[str] ) -> Tuple[bool, int]:
-        if not target in self.rules:
-            raise NoRuleError(target)
-        if target in build_path:
-            raise CyclicGraphError(target, build_path)
+        pattern_rule = PatternRule(patterns, rule_type, configure)
+        self.pattern_rules.add(pattern_rule)
+        return pattern_rule
 
-        if target in self.build_tree:
-            # if len(build_path) > 0 :
-            #     self.build_tree[target]['dependants'].add(build_path[-1])
-            needs_to_build = self.build_tree[target]['needs_to_build']
-            last_build_time = self.build_tree[target]['last_build_time']
-            return (needs_to_build, last_build_time)
+    def _canMake(self, name: str) -> bool:
+        # A pattern rule without prerequisites, such as one for source files, only counts for files that exist.
+        if name in self.rules or self.stat_cache.exists(name):
+            return True
+        return any([len(pattern_rule.prerequisites) > 0 for (_, pattern_rule) in self.pattern_rules.match(name)])
 
-        rule = self.rules[target]
-        self.build_tree[target] = {}
+    def _findRule(self, name: str) -> Optional[Rule]:
+        rule = self.rules.get(name)
+        if rule is not None or len(self.pattern_rules) == 0:
+            return rule
+        matches = self.pattern_rules.match(name)
+        if len(matches) == 0:
+            return None
 
-        # self.build_tree[target]['dependants'] = set()
-        # if len(build_path) > 0 :
-        #     self.build_tree[target]['dependants'].add(build_path[-1])
+        # As in make, the first match whose prerequisites exist or can be made is used, and with
+        # none the name has no rule.
+        for (stem, pattern_rule) in matches:
+            if all([self._canMake(dep) for dep in pattern_rule.getPrerequisiteNames(stem)]):
+                break
+        else:
+            return None
 
-        needs_to_build = rule.forceRebuild()
-        self.build_tree[target]['needs_to_build'] = needs_to_build
+        rule = pattern_rule.materialise(stem)
+        for tgt in rule.names:
+            if tgt in self.rules:
+                raise DuplicateRuleError(tgt)
+        for tgt in rule.names:
+            self.rules[tgt] = rule
+        return rule
 
-        last_build_time = -1
-        self.build_tree[target]['last_build_time'] = -1
+    def setDotGraphOptions(self, file_name: str, rename_func: Optional[Callable[[str], str]] = None, dirty_only: bool = False,
+                           targets: Optional[List[str]] = None, hops: Optional[int] = None, critical_path: bool = False,
+                           graph_format: Optional[str] = None) -> None:
+        # The graph is written on every build. It can be limited to the rules that need building, to
+        # the rules within hops prerequisites of the targets, or to the expected critical path, and
+        # each limit narrows the others. The format is 'dot', 'json' or 'graphml', by default taken
+        # from the file extension with dot for anything else.
+        self.dot_file_name = file_name
+        self.dot_rename_func = rename_func
+        self.dot_dirty_only = dirty_only
+        self.dot_targets = targets
+        self.dot_hops = hops
+        self.dot_critical_path = critical_path
+        self.dot_format = graph_format
 
-        prerequisites = rule.getPrerequisites()
-        self.build_tree[target]['prerequisites'] = set(prerequisites)
+    
+    def _enterNode(self, node: int) -> None:
+        graph = self.graph
+        rule = graph.rules[node]
+        graph.entered[node] = 1
 
-        if not rule.exists():
-            needs_to_build = True
-            self.build_tree[target]['needs_to_build'] = True
-        else:
-            last_build_time = rule.getLastBuildTime()
-            self.build_tree[target]['last_build_time'] = last_build_time
+        # Only the first reason found is kept.
+        reason = None
+        if rule.forceRebuild():
+            reason = FORCED_REASON
+        elif self.journal is not None and rule.names[0] in self.journal.interrupted:
+            # A rule that a killed or failed build left unfinished may have a partly written output.
+            reason = INTERRUPTED_REASON
+        last_build_time = -1
+        prerequisites = rule.getPrerequisites()
+        # Several names of one rule are one node, dict.fromkeys drops the duplicates in order.
+        prerequisite_nodes = dict.fromkeys([graph.getNode(dep, self._findRule) for dep in prerequisites])
+        for dep in self._getDiscovered().get(rule.names[0], []):
+            if dep in graph.ids or self._findRule(dep) is not None:
+                prerequisite_nodes[graph.getNode(dep, self._findRule)] = None
+            elif self.stat_cache.exists(dep):
+                # Discovered files without a rule are sources.
+                prerequisite_nodes[graph.addNode(FileExistsRule([dep]))] = None
+            else:
+                # A file read by the last build has gone, so the rule has to run again.
+                if reason is None:
+                    reason = Reason(DISCOVERED_MISSING, dep)
+        graph.setPrerequisites(node, list(prerequisite_nodes))
 
         for setting in rule.getSettings():
             if not self.settings.exists(setting):
                 raise NoSettingError(setting)
-            elif last_build_time < self.settings.getLastBuildTime(setting):
-                needs_to_build = True
-                self.build_tree[target]['needs_to_build'] = True
-                # Don't return from here as the whole dependency graph needs to be built up.
-                break
 
-        if len(prerequisites) == 0:
-            for tgt in rule.names:
-                if tgt == target:
-                    continue
-                self.build_tree[tgt] = self.build_tree[target]
-            return (needs_to_build, last_build_time)
-
-        prerequisite_build_times: List[int] = []
-        prerequisite_build_path = [*build_path, target]
-        for dep in prerequisites:
-            (dep_needs_to_build, dep_last_build_time) = self._computeBuildSubGraph(dep, prerequisite_build_path)
-            if dep_needs_to_build or last_build_time < dep_last_build_time:
-                needs_to_build = True
-                self.build_tree[target]['needs_to_build'] = True
-                # Don't break here as the loop has to run all the dependencies through the recurcive call.
+        record = None
+        if self.state is not None:
+            fingerprint = self.settings.getFingerprint(rule.getSettings())
+            graph.fingerprints[node] = fingerprint
+            record = self.state.getRecord(rule.names[0])
+            # The rule may have changed since it was last built.
+            if record is not None and reason is None and record[1] != sorted(prerequisites):
+                changed = sorted(set(record[1]) ^ set(prerequisites))
+                reason = Reason(PREREQUISITES_CHANGED, changed[0] if len(changed) > 0 else None)
+            if record is not None and reason is None and record[2] != fingerprint:
+                (setting, setting_time) = self._newestSetting(rule)
+                reason = Reason(SETTINGS_CHANGED, setting, setting_time, record[0])
 
-        for tgt in rule.names:
-            if tgt == target:
+        if (record is not None and self.trust_recorded_outputs and len(prerequisites) > 0
+                and not (isinstance(rule, FileExistsRule) and self.stat_cache.knownMissing(rule.names))):
+            last_build_time = record[0]
+        elif not rule.exists():
+            if reason is None:
+                reason = MISSING_OUTPUT_REASON
+        else:
+            last_build_time = rule.getLastBuildTime()
+
+        if record is None and reason is None and last_build_time < self.settings.getLastBuildTimeForNames(rule.getSettings()):
+            (setting, setting_time) = self._newestSetting(rule)
+            reason = Reason(NEWER_SETTING, setting, setting_time, last_build_time)
+
+        if reason is not None:
+            graph.reasons[node] = reason
+        else:
+            graph.reasons.pop(node, None)
+        graph.needs_to_build[node] = reason is not None
+        graph.stale[node] = reason is not None
+        graph.last_build_time[node] = last_build_time
+
+    def _newestSetting(self, rule: Rule) -> Tuple[Optional[str], int]:
+        settings = rule.getSettings()
+        if len(settings) == 0:
+            return (None, -1)
+        setting = max(settings, key=self.settings.getLastBuildTime)
+        return (setting, self.settings.getLastBuildTime(setting))
+
+    def _reachableTargets(self, targets: List[str]) -> List[str]:
+        reachable = []
+        seen = set()
+        discovered = self._getDiscovered()
+        stack = list(targets)
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in seen:
+                continue
+            rule = self._findRule(name)
+            if rule is None:
+                seen.add(name)
+                reachable.append(name)
                 continue
-            self.build_tree[tgt] = self.build_tree[target]
-        return (needs_to_build, last_build_time)
+            seen.update(rule.names)
+            reachable.extend(rule.names)
+            stack.extend(rule.getPrerequisites())
+            stack.extend(discovered.get(rule.names[0], []))
+        return reachable
 
-    def _findNextBuildTargets(self):
-        leaves = []
-        for target, details in self.build_tree.items():
-            if target in self.built_rules:
+    def _computeBuildSubGraph(self, target: str) -> Tuple[bool, int]:
+        # Depth first search with an explicit stack, so that the depth of the graph is not limited by
+        # the recursion limit. Each frame is [node, index of the next prerequisite in prerequisite_ids].
+        graph = self.graph
+        root = graph.getNode(target, self._findRule)
+        if not graph.entered[root]:
+            self._enterNode(root)
+            path = [[root, graph.prerequisite_start[root]]]
+            on_path = {root}
+
+            while len(path) > 0:
+                frame = path[-1]
+                node = frame[0]
+                if frame[1] < graph.prerequisite_end[node]:
+                    dep = graph.prerequisite_ids[frame[1]]
+                    frame[1] += 1
+                    if dep in on_path:
+                        start = len(path) - 1
+                        while path[start][0] != dep:
+                            start -= 1
+                        cycle = [graph.getName(f[0]) for f in path[start:]] + [graph.getName(dep)]
+                        raise CyclicGraphError(graph.getName(dep), cycle)
+                    if not graph.entered[dep]:
+                        self._enterNode(dep)
+                        path.append([dep, graph.prerequisite_start[dep]])
+                        on_path.add(dep)
+                        continue
+                else:
+                    path.pop()
+                    on_path.discard(node)
+                    if len(path) == 0:
+                        break
+                    dep = node
+                    node = path[-1][0]
+
+                if graph.stale[node] or (graph.needs_to_build[node] and not self.early_cutoff):
+                    continue
+                if graph.needs_to_build[dep]:
+                    if not graph.needs_to_build[node]:
+                        graph.reasons[node] = Reason(PREREQUISITE_REBUILT, graph.getName(dep))
+                    graph.needs_to_build[node] = 1
+                    if not self.early_cutoff:
+                        continue
+                # With early cutoff the dependency's current output still has to be compared, as the
+                # rule is skipped if the dependency rebuilds it unchanged.
+                if graph.last_build_time[node] < graph.last_build_time[dep] and self._inputChanged(node, dep):
+                    graph.reasons[node] = Reason(NEWER_PREREQUISITE, graph.getName(dep), graph.last_build_time[dep], graph.last_build_time[node])
+                    graph.needs_to_build[node] = 1
+                    graph.stale[node] = 1
+
+        return (bool(graph.needs_to_build[root]), graph.last_build_time[root])
+
+    def _initialiseReadyQueue(self) -> None:
+        graph = self.graph
+        count = len(graph)
+        self.status = bytearray(count)
+        self.built_rules = NodeSetView(graph, self.status, BUILT)
+        pending = bytearray(count)
+        for node in graph.enteredNodes():
+            if graph.needs_to_build[node]:
+                pending[node] = 1
+            else:
+                self.status[node] = BUILT
+
+        (self.dependant_offsets, self.dependant_ids) = graph.reverseAdjacency(pending)
+        self.pending_counts = array('i', bytes(4 * count))
+        for node in range(count):
+            if pending[node]:
+                for dep in graph.prerequisites(node):
+                    if pending[dep]:
+                        self.pending_counts[node] += 1
+
+        self.ready_queue = []
+        self.ready_count = 0
+        self.previous_outputs = {}
+        self.output_changed = bytearray(count)
+        self._computePriorities(pending)
+        for node in range(count):
+            if pending[node] and self.pending_counts[node] == 0:
+                self._pushReady(node)
+
+    def _dependantsOf(self, node: int) -> array:
+        return self.dependant_ids[self.dependant_offsets[node]:self.dependant_offsets[node+1]]
+
+    def _getDurations(self) -> Dict[str, float]:
+        if self.state is not None:
+            return self.state.durations
+        return self.durations
+
+    def _getDiscovered(self) -> Dict[str, List[str]]:
+        if self.state is not None:
+            return self.state.discovered
+        return self.discovered
+
+    def _computePriorities(self, pending: bytearray) -> None:
+        # The priority of a rule is the expected time from its start to the end of the build, which is
+        # its own duration plus the longest chain of durations through its dependants. Rules without
+        # a recorded duration are assumed to take the average time.
+        graph = self.graph
+        durations = self._getDurations()
+        known = [durations[graph.getName(node)] for node in range(len(graph)) if pending[node] and graph.getName(node) in durations]
+        if len(known) > 0:
+            default_duration = sum(known) / len(known)
+        else:
+            default_duration = 1.0
+
+        # Dependants are finished before the rules they depend on, depth first.
+        self.priorities = array('d', bytes(8 * len(graph)))
+        done = bytearray(len(graph))
+        for root in range(len(graph)):
+            if not pending[root] or done[root]:
                 continue
-            elif not details['needs_to_build']:
+            stack = [root]
+            while len(stack) > 0:
+                current = stack[-1]
+                waiting = False
+                for dep in self._dependantsOf(current):
+                    if not done[dep]:
+                        stack.append(dep)
+                        waiting = True
+                if waiting:
+                    continue
+                stack.pop()
+                if done[current]:
+                    continue
+                longest = max(self._dependantsOf(current), key=lambda dep: self.priorities[dep], default=None)
+                self.priorities[current] = durations.get(graph.getName(current), default_duration)
+                if longest is not None:
+                    self.priorities[current] += self.priorities[longest]
+                done[current] = 1
+
+    def _pushReady(self, node: int) -> None:
+        # The count keeps rules with equal priority in the order they became ready.
+        heapq.heappush(self.ready_queue, (-self.priorities[node], self.ready_count, node))
+        self.ready_count += 1
+
+    def _popReady(self) -> int:
+        return heapq.heappop(self.ready_queue)[2]
+
+    def _blockingResource(self, rule: Rule, idle: bool) -> Optional[str]:
+        # A rule that needs more than the whole capacity still runs, but only when nothing else is.
+        for name, amount in rule.getResources().items():
+            if name not in self.resource_capacity:
                 continue
-            elif details['prerequisites'].issubset(self.built_rules):
-                leaves.append( target)
+            if self.resources_in_use.get(name, 0) + amount > self.resource_capacity[name] and not idle:
+                return name
+        return None
+
+    def _wakeWaiting(self, name: str, idle: bool) -> None:
+        # Moves the waiting rules that fit in what is free of the resource back to the ready queue,
+        # highest priority first. Waiting rules are kept by the amount they need, so this only looks
+        # at the head of each amount rather than at every waiting rule.
+        by_amount = self.waiting.get(name)
+        if by_amount is None:
+            return
+        free = self.resource_capacity[name] - self.resources_in_use.get(name, 0)
+        while True:
+            heads = [(entries[0], amount) for amount, entries in by_amount.items() if len(entries) > 0 and (amount <= free or idle)]
+            if len(heads) == 0:
+                break
+            (_, amount) = min(heads)
+            heapq.heappush(self.ready_queue, heapq.heappop(by_amount[amount]))
+            free -= amount
+            idle = False
+
+    def _acquireResources(self, rule: Rule) -> None:
+        for name, amount in rule.getResources().items():
+            self.resources_in_use[name] = self.resources_in_use.get(name, 0) + amount
+
+    def _releaseResources(self, rule: Rule) -> None:
+        for name, amount in rule.getResources().items():
+            self.resources_in_use[name] -= amount
+            self._wakeWaiting(name, False)
+
+    def _takeReadyRules(self, slots: int, idle: bool) -> List[Rule]:
+        # Pops up to slots ready rules in priority order. Rules whose resources do not fit wait for
+        # the resource that blocked them to be released, so lighter rules behind them can still start
+        # and they are not looked at again until they might fit.
+        if idle:
+            for name in list(self.waiting):
+                self._wakeWaiting(name, True)
+        started = []
+        while len(started) < slots and len(self.ready_queue) > 0:
+            entry = heapq.heappop(self.ready_queue)
+            rule = self.graph.rules[entry[2]]
+            blocking = self._blockingResource(rule, idle and len(started) == 0)
+            if blocking is None:
+                self._acquireResources(rule)
+                started.append(rule)
+            else:
+                amount = rule.getResources()[blocking]
+                heapq.heappush(self.waiting.setdefault(blocking, {}).setdefault(amount, []), entry)
+        return started
+
+    def _recordDuration(self, key: str, seconds: float) -> None:
+        # Exponential moving average, so a single slow or fast run does not swing the estimate.
+        durations = self._getDurations()
+        if key in durations:
+            seconds = 0.7 * durations[key] + 0.3 * seconds
+        if self.state is not None:
+            self.state.setDuration(key, seconds)
+        else:
+            durations[key] = seconds
+
+    def _inputHashes(self, node: int) -> Dict[str, str]:
+        hashes = {}
+        for dep in self.graph.prerequisites(node):
+            digest = self.graph.rules[dep].getContentHash(self.state.file_hashes)
+            if digest is not None:
+                hashes[self.graph.getName(dep)] = digest
+        return hashes
+
+    def _recordState(self) -> None:
+        if self.state is not None:
+            graph = self.graph
+            for node in graph.enteredNodes():
+                rule = graph.rules[node]
+                name = rule.names[0]
+                if node < len(self.status) and self.status[node] == FAILED:
+                    self.state.removeRecord(name)
+                elif node < len(self.status) and self.status[node] == BUILT:
+                    if not graph.needs_to_build[node]:
+                        last_build_time = graph.last_build_time[node]
+                    elif rule.exists():
+                        last_build_time = rule.getLastBuildTime()
+                    else:
+                        last_build_time = -1
+                    self.state.setRecord(name, last_build_time, rule.getPrerequisites(), graph.fingerprints[node])
+                    if self.use_content_hashes:
+                        self.state.setInputHashes(name, self._inputHashes(node))
+            self.state.commit()
+        if self.journal is not None:
+            # The results are saved, so the journal only needs to remember what is still unfinished.
+            self.journal.reset(self.failed_rules)
+
+    def _resumeJournal(self) -> None:
+        # Saves the records of the rules a killed build finished, as it did not get to save them.
+        if self.journal is None or self.state is None:
+            return
+        for name, entry in self.journal.completed.items():
+            if 'prerequisites' in entry:
+                self.state.setRecord(name, entry['last_build_time'], entry['prerequisites'], entry['settings_fingerprint'])
+            if 'input_hashes' in entry:
+                self.state.setInputHashes(name, entry['input_hashes'])
+        self.journal.completed = {}
+
+    def _findNextBuildTargets(self) -> List[int]:
+        leaves = []
+        while len(self.ready_queue) > 0:
+            leaves.append(self._popReady())
         return leaves
 
-    def build(self, target: str) -> None:
+    def _prepareBuild(self, targets: Union[str, List[str]], jobs: int, incremental: bool = False) -> None:
+        # An incremental build keeps the parts of the build_tree that have not been invalidated.
+        if jobs < 1:
+            raise ValueError("jobs must be at least 1, got %s." % jobs)
 
         self._print('b', 'Starting building dependency graph with %s rules.' % (len(self.rules.items())))
 
-        self.build_tree = {}
-        self.built_rules.clear()
+        if not incremental:
+            self.graph.clear()
+        self.failed_rules.clear()
+        self.skipped_rules = []
+        self.resources_in_use = {}
+        self.waiting = {}
         self.trace=[]
+        self.timings=[]
+        if self.profiler is not None:
+            self.profiler.clear()
 
         start_time = datetime.now()
-        self._computeBuildSubGraph(target, [])
+        if not incremental:
+            self.stat_cache.clear()
+        self._resumeJournal()
+        if self.prefetch_stats:
+            self._profilePhase('stat prefetch', lambda: self.stat_cache.prefetch(self._reachableTargets(targets), self.prefetch_threads))
+        for target in targets:
+            self._profilePhase('graph construction', lambda: self._computeBuildSubGraph(target))
 
+        self._initialiseReadyQueue()
         if self.dot_file_name is not None:
             self._drawGraph()
+        targets_to_build = len([node for node in self.graph.enteredNodes() if self.graph.needs_to_build[node]])
+
+        end_time = datetime.now()
+        self._print('g', '    Completed building dependency graph. Took %s' % (end_time-start_time))
+        self._print('b', 'Found %s targets that need building.' % ( targets_to_build))
+
+        if self.profiler is not None:
+            self.profiler.addCounter('stat calls', self.stat_cache.stat_calls)
+            self.profiler.addCounter('stat time', self.stat_cache.stat_time_ns * 1e-9)
+
+    @_usingStatCache
+    def build(self, targets: Union[str, List[str]], jobs: int = 1, keep_going: bool = False) -> None:
+        # All the targets share one dependency graph, so common prerequisites are built once.
+        if type(targets) == str:
+            targets = [str(targets)]
+        self._prepareBuild(targets, jobs)
+
+        try:
+            if jobs == 1:
+                self._profilePhase('building', lambda: self._buildSerial(keep_going))
+            else:
+                self._profilePhase('building', lambda: self._buildParallel(jobs, keep_going))
+        finally:
+            self._recordState()
+
+        if len(self.failed_rules) > 0:
+            raise BuildError("Failed to build: %s." % (', '.join(sorted(self.failed_rules))))
 
-        targets_to_build = 0
-        for target, details in self.build_tree.items():
-            if target in self.built_rules:
+    def _invalidate(self, changed: Set[str], dependants: Tuple[array, array]) -> None:
+        # Drops the changed targets and everything that depends on them from the build graph, so that
+        # the next incremental build only looks at those again.
+        self.stat_cache.invalidate(changed)
+        (offsets, ids) = dependants
+        stack = [self.graph.ids[name] for name in changed if name in self.build_tree]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not self.graph.entered[node]:
                 continue
-            elif not details['needs_to_build']:
-                self.built_rules.add(target)
+            self.graph.entered[node] = 0
+            stack.extend(ids[offsets[node]:offsets[node+1]])
+
+    def _refreshBuiltDetails(self) -> None:
+        # After a build the details of the rules that ran describe them as they were before it.
+        for (names, _, _) in self.timings:
+            node = self.graph.ids[names[0]]
+            rule = self.graph.rules[node]
+            self.graph.needs_to_build[node] = 0
+            self.graph.stale[node] = 0
+            self.graph.reasons.pop(node, None)
+            if rule.exists():
+                self.graph.last_build_time[node] = rule.getLastBuildTime()
             else:
-                targets_to_build += 1
+                self.graph.last_build_time[node] = -1
 
-        leaves = self._findNextBuildTargets()
+    @_usingStatCache
+    def watch(self, targets: Union[str, List[str]], jobs: int = 1, max_builds: Optional[int] = None, watcher: Any = None, poll_interval: float = 0.1) -> None:
+        # Builds the targets, then waits for any file in the graph to change and rebuilds only the
+        # changed targets and their dependants. Runs until max_builds builds have been done.
+        if type(targets) == str:
+            targets = [str(targets)]
 
-        end_time = datetime.now()
-        self._print('g', '    Completed building dependency graph. Took %s' % (end_time-start_time))
-        self._print('b', 'Found %s targets that need building.' % ( targets_to_build))
+        own_watcher = watcher is None
+        builds = 0
+        incremental = False
+        try:
+            while True:
+                try:
+                    self._prepareBuild(targets, jobs, incremental)
+                    try:
+                        if jobs == 1:
+                            self._buildSerial(True)
+                        else:
+                            self._buildParallel(jobs, True)
+                    finally:
+                        self._recordState()
+                    if len(self.failed_rules) > 0:
+                        self._print('r', 'Failed to build: %s.' % (', '.join(sorted(self.failed_rules))))
+                except NoSettingError as e:
+                    self._print('r', str(e))
+                self._refreshBuiltDetails()
+                builds += 1
+                if max_builds is not None and builds >= max_builds:
+                    break
+
+                # Each build can find more to watch, as dependencies are discovered or directories added.
+                watched = self._watchedPaths()
+                if watcher is None:
+                    watcher = createWatcher(watched.keys(), poll_interval)
+                else:
+                    watcher.add(watched.keys())
+                outputs = {}
+                for (names, _, _) in self.timings:
+                    for name in names:
+                        outputs[name] = self._fileState(name)
+                dependants = self.graph.reverseAdjacency(self.graph.entered)
+
+                changed = set()
+                while len(changed) == 0:
+                    for path in watcher.wait(poll_interval):
+                        # Ignore the events caused by writing the outputs of the last build.
+                        if path in outputs and outputs[path] == self._fileState(path):
+                            continue
+                        changed.add(watched.get(path, path))
+
+                self._print('b', 'Changed: %s.' % (', '.join(sorted(changed))))
+                self._invalidate(changed, dependants)
+                incremental = True
+        finally:
+            if own_watcher and watcher is not None:
+                watcher.close()
 
+    def _watchedPaths(self) -> Dict[str, str]:
+        # The paths to watch, each with the name in the graph that it changes. A directory rule is
+        # changed by any entry in its directories, which covers its files and new directories. A
+        # dependency the last build discovered is not in the graph yet, so it changes its dependant.
+        watched = {name: name for name in self.build_tree}
+        discovered = self._getDiscovered()
+        for node in self.graph.enteredNodes():
+            rule = self.graph.rules[node]
+            for dep in discovered.get(rule.names[0], []):
+                watched.setdefault(dep, rule.names[0])
+            if isinstance(rule, DirectoryRule):
+                for directory in rule.getDirectories():
+                    watched[os.path.join(directory, '')] = rule.names[0]
+        return watched
+
+    def _fileState(self, name: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(name)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @_usingStatCache
+    async def buildAsync(self, targets: Union[str, List[str]], jobs: int = 1, keep_going: bool = False) -> None:
+        # Runs up to jobs rules at once on the running event loop. Rules that do not override
+        # BaseRule.buildAsync run in threads, or in a process pool if they ask for one.
+        if type(targets) == str:
+            targets = [str(targets)]
+        self._prepareBuild(targets, jobs)
+
+        start_time = datetime.now()
+        try:
+            await self._buildAsync(jobs, keep_going)
+        finally:
+            if self.profiler is not None:
+                self.profiler.addPhase('building', start_time, datetime.now())
+            self._recordState()
+
+        if len(self.failed_rules) > 0:
+            raise BuildError("Failed to build: %s." % (', '.join(sorted(self.failed_rules))))
+
+    def _profilePhase(self, name: str, func: Callable[[], Any]) -> None:
+        if self.profiler is None:
+            func()
+            return
+        start_time = datetime.now()
+        try:
+            func()
+        finally:
+            self.profiler.addPhase(name, start_time, datetime.now())
+
+    def _markBuilt(self, rule: Rule, start_time: datetime, end_time: datetime, cpu_time: float = 0.0, worker: str = 'main', discovered: Optional[List[str]] = None) -> None:
+        self.stat_cache.invalidate(rule.names)
+        node = self.graph.ids[rule.names[0]]
+        self.status[node] = BUILT
+        self.timings.append((list(rule.names), start_time, end_time))
+        if self.profiler is not None:
+            self.profiler.addRule(rule.names, start_time, end_time, cpu_time, worker)
+        if worker != 'cache':
+            self._recordDuration(rule.names[0], (end_time - start_time).total_seconds())
+        if discovered is not None:
+            if self.state is not None:
+                self.state.setDiscovered(rule.names[0], discovered)
+            else:
+                self.discovered[rule.names[0]] = discovered
+        if self.journal is not None:
+            record = {'last_build_time': rule.getLastBuildTime() if rule.exists() else -1}
+            if self.state is not None:
+                record['prerequisites'] = rule.getPrerequisites()
+                record['settings_fingerprint'] = self.graph.fingerprints[node]
+                if self.use_content_hashes:
+                    record['input_hashes'] = self._inputHashes(node)
+            self.journal.finish(rule.names[0], record)
+
+        if self.early_cutoff:
+            digest = rule.getContentHash(self.state.file_hashes)
+            previous = self.previous_outputs.pop(node, None)
+            self.output_changed[node] = digest is None or previous is None or digest != previous
+        else:
+            self.output_changed[node] = 1
+
+        stack = [node]
+        while len(stack) > 0:
+            current = stack.pop()
+            for dependant in self._dependantsOf(current):
+                self.pending_counts[dependant] -= 1
+                if self.pending_counts[dependant] != 0:
+                    continue
+                elif self._canSkip(dependant):
+                    self._skipRule(dependant)
+                    stack.append(dependant)
+                else:
+                    self._pushReady(dependant)
+
+    def _rememberOutputs(self, rule: Rule) -> None:
+        if self.early_cutoff:
+            self.previous_outputs[self.graph.ids[rule.names[0]]] = rule.getContentHash(self.state.file_hashes)
+
+    def _canSkip(self, node: int) -> bool:
+        # Only the rules that are out of date just because their prerequisites were rebuilt can be
+        # skipped, and only if none of those prerequisites' outputs changed.
+        if not self.early_cutoff or self.graph.stale[node]:
+            return False
+        for dep in self.graph.prerequisites(node):
+            if self.output_changed[dep]:
+                return False
+        return True
+
+    def _skipRule(self, node: int) -> None:
+        self._print('g', 'Skipping "%s", its inputs are unchanged.' % (self.graph.rules[node].getTargetStr()))
+        self.status[node] = BUILT
+        self.graph.needs_to_build[node] = 0
+        self.skipped_rules.extend(self.graph.rules[node].names)
+        if self.profiler is not None:
+            self.profiler.addCounter('early cutoff skips', 1)
+
+    def _buildSerial(self, keep_going: bool) -> None:
         total_start_time = datetime.now()
+        rule_time = 0.0
 
+        leaves = self._findNextBuildTargets()
         while len(leaves) > 0 :
             self.trace.append([])
             for leaf in leaves:
+                if self.status[leaf] != PENDING:
+                    continue
+                rule = self.graph.rules[leaf]
+                start_time = datetime.now()
+                self._print('b', 'Starting "%s" at %s' % (rule.getTargetStr(), start_time))
+                settings_values = self.settings.getValuesForNames(rule.getSettings())
+                cpu_time = 0.0
+                worker = 'cache'
+                discovered = None
+                self._rememberOutputs(rule)
+                if self.journal is not None:
+                    self.journal.start(rule.names[0])
                 try:
-                    if leaf in self.built_rules:
-                        continue
-                    rule = self.rules[leaf]
-                    start_time = datetime.now()
-                    self._print('b', 'Starting "%s" at %s' % (rule.getTargetStr(), start_time))
-                    settings_values = self.settings.getValuesForNames(rule.getSettings())
-                    try:
-                        rule.build(settings_values)
-                        end_time = datetime.now()
-                        self._print('g', '    done "%s" at %s.\n     Took %s, Total %s' % (rule.getTargetStr(), end_time, end_time - start_time, end_time-total_start_time))
-                    except:
-                        end_time = datetime.now()
-                        self._print('r', '    failed "%s" at %s.\n     Took %s, Total %s' % (rule.getTargetStr(), end_time, end_time - start_time, end_time-total_start_time))
-                        raise
+                    cache_key = self._getCacheKey(rule, settings_values)
+                    if cache_key is not None and self.artifact_cache.restore(cache_key, rule.names):
+                        self._print('g', '    restored "%s" from the artifact cache.' % (rule.getTargetStr()))
+                    else:
+                        (start_time, _, cpu_time, worker, discovered) = _runRule(rule, settings_values)
+                        if cache_key is not None:
+                            self.artifact_cache.save(cache_key, rule.names)
+                    end_time = datetime.now()
+                    rule_time += (end_time - start_time).total_seconds()
+                    self._print('g', '    done "%s" at %s.\n     Took %s, Total %s' % (rule.getTargetStr(), end_time, end_time - start_time, end_time-total_start_time))
                 except:
-                    raise
+                    end_time = datetime.now()
+                    self._print('r', '    failed "%s" at %s.\n     Took %s, Total %s' % (rule.getTargetStr(), end_time, end_time - start_time, end_time-total_start_time))
+                    rule_time += (end_time - start_time).total_seconds()
+                    self.status[leaf] = FAILED
+                    self.failed_rules.update(rule.names)
+                    if self.journal is not None:
+                        self.journal.fail(rule.names[0])
+                    if not keep_going:
+                        raise
+                    continue
 
-                for name in rule.names:
-                    self.built_rules.add(name)
-                # self.trace[-1].append(leaf)
+                self._markBuilt(rule, start_time, end_time, cpu_time, worker, discovered)
                 self.trace[-1].extend(rule.names)
+            if len(self.trace[-1]) == 0:
+                self.trace.pop()
             leaves = self._findNextBuildTargets()
 
-    def _drawGraph(self) -> None:
-        lines = []
-        lines.append('digraph build_tree {')
-        lines.append('graph [rankdir="LR"]')
-        ids = {'_last_id': 1}
-
-        def findOrInsert(name: str, ids: Dict[str,int]) -> int:
-            if name in ids:
-                return ids[name]
-            last_id = ids['_last_id']
-            last_id += 1
-            ids[name] = last_id
-            ids['_last_id'] = last_id
-            return last_id
-
-        for target, details in self.build_tree.items():
-            tgt_id = findOrInsert(target, ids)
-            if self.dot_rename_func is not None:
-                tgt_name = self.dot_rename_func(target)
-            else:
-                tgt_name = target
+        if self.profiler is not None:
+            self.profiler.addCounter('scheduling time', (datetime.now() - total_start_time).total_seconds() - rule_time)
 
-            if tgt_name is not None:
-                lines.append('node_%s [label="%s"]' % (tgt_id, tgt_name))
+    def _startRule(self, rule: Rule) -> Tuple[Dict[str, Any], Optional[str], bool]:
+        # Returns the settings values and cache key for the rule, and whether it was restored from the cache.
+        self._print('b', 'Starting "%s" at %s' % (rule.getTargetStr(), datetime.now()))
+        self._rememberOutputs(rule)
+        if self.journal is not None:
+            self.journal.start(rule.names[0])
+        settings_values = self.settings.getValuesForNames(rule.getSettings())
+        cache_key = self._getCacheKey(rule, settings_values)
+        if cache_key is not None and self.artifact_cache.restore(cache_key, rule.names):
+            restore_time = datetime.now()
+            self._print('g', '    restored "%s" from the artifact cache.' % (rule.getTargetStr()))
+            self._markBuilt(rule, restore_time, restore_time, 0.0, 'cache')
+            self.trace.append(list(rule.names))
+            return (settings_values, cache_key, True)
+        return (settings_values, cache_key, False)
 
-            for dep in details['prerequisites']:
-                dep_id = findOrInsert(dep, ids)
-                if dep_id is not None:
-                    lines.append('node_%s -> node_%s' % (dep_id, tgt_id))
+    def _finishRule(self, rule: Rule, cache_key: Optional[str], result: Tuple[datetime, datetime, float, str, Optional[List[str]]], total_start_time: datetime) -> None:
+        (start_time, end_time, cpu_time, worker, discovered) = result
+        if cache_key is not None:
+            self.artifact_cache.save(cache_key, rule.names)
+        self._print('g', '    done "%s" at %s.\n     Took %s, Total %s' % (rule.getTargetStr(), end_time, end_time - start_time, end_time-total_start_time))
+        self._markBuilt(rule, start_time, end_time, cpu_time, worker, discovered)
+        self.trace.append(list(rule.names))
 
-        lines.append('}')
+    def _failRule(self, rule: Rule, total_start_time: datetime) -> None:
+        end_time = datetime.now()
+        self._print('r', '    failed "%s" at %s.\n     Total %s' % (rule.getTargetStr(), end_time, end_time-total_start_time))
+        self.status[self.graph.ids[rule.names[0]]] = FAILED
+        self.failed_rules.update(rule.names)
+        if self.journal is not None:
+            self.journal.fail(rule.names[0])
+
+    def _buildParallel(self, jobs: int, keep_going: bool) -> None:
+        # In parallel mode each entry of the trace is one finished rule, in completion order.
+        total_start_time = datetime.now()
+        executors = {}
+        running = {}
+        error = None
+        wait_time = 0.0
+
+        def getExecutor(name: str):
+            if name in self.executors:
+                return self.executors[name]
+            if name not in executors:
+                if name == 'thread':
+                    executors[name] = ThreadPoolExecutor(max_workers=jobs)
+                elif name == 'process':
+                    executors[name] = ProcessPoolExecutor(max_workers=jobs)
+                else:
+                    raise ValueError("Unknown executor %s." % name)
+            return executors[name]
+
+        try:
+            while True:
+                while error is None:
+                    rules = self._takeReadyRules(jobs - len(running), len(running) == 0)
+                    if len(rules) == 0:
+                        break
+                    for rule in rules:
+                        (settings_values, cache_key, restored) = self._startRule(rule)
+                        if restored:
+                            self._releaseResources(rule)
+                            continue
+                        if rule.getExecutor() == 'thread':
+                            # The rule's thread sees the same active stat cache as this one.
+                            future = getExecutor('thread').submit(contextvars.copy_context().run, _runRule, rule, settings_values)
+                        else:
+                            future = getExecutor(rule.getExecutor()).submit(_runRule, rule, settings_values)
+                        running[future] = (rule, cache_key)
+
+                if len(running) == 0:
+                    break
+
+                wait_start_time = time.perf_counter()
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                wait_time += time.perf_counter() - wait_start_time
+                for future in done:
+                    (rule, cache_key) = running.pop(future)
+                    self._releaseResources(rule)
+                    try:
+                        self._finishRule(rule, cache_key, future.result(), total_start_time)
+                    except Exception as e:
+                        self._failRule(rule, total_start_time)
+                        if not keep_going and error is None:
+                            error = e
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+        if self.profiler is not None:
+            self.profiler.addCounter('scheduling time', (datetime.now() - total_start_time).total_seconds() - wait_time)
+
+        if error is not None:
+            raise error
+
+    async def _runRuleAsync(self, rule: Rule, settings_values: Dict[str, Any], process_pool: ProcessPoolExecutor) -> Tuple[datetime, datetime, float, str, Optional[List[str]]]:
+        if rule.getExecutor() == 'process':
+            return await asyncio.get_running_loop().run_in_executor(process_pool, _runRule, rule, settings_values)
+        elif rule.getExecutor() in self.executors:
+            return await asyncio.get_running_loop().run_in_executor(self.executors[rule.getExecutor()], _runRule, rule, settings_values)
+        start_time = datetime.now()
+        discovered = await rule.buildAsync(settings_values)
+        return (start_time, datetime.now(), 0.0, 'async', discovered)
+
+    async def _buildAsync(self, jobs: int, keep_going: bool) -> None:
+        total_start_time = datetime.now()
+        process_pool = None
+        running = {}
+        error = None
+
+        try:
+            while True:
+                while error is None:
+                    rules = self._takeReadyRules(jobs - len(running), len(running) == 0)
+                    if len(rules) == 0:
+                        break
+                    for rule in rules:
+                        (settings_values, cache_key, restored) = self._startRule(rule)
+                        if restored:
+                            self._releaseResources(rule)
+                            continue
+                        if rule.getExecutor() == 'process' and process_pool is None:
+                            process_pool = ProcessPoolExecutor(max_workers=jobs)
+                        task = asyncio.ensure_future(self._runRuleAsync(rule, settings_values, process_pool))
+                        running[task] = (rule, cache_key)
+
+                if len(running) == 0:
+                    break
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    (rule, cache_key) = running.pop(task)
+                    self._releaseResources(rule)
+                    if task.cancelled():
+                        continue
+                    try:
+                        self._finishRule(rule, cache_key, task.result(), total_start_time)
+                    except Exception as e:
+                        self._failRule(rule, total_start_time)
+                        if not keep_going and error is None:
+                            error = e
+                            # Stop the rules that are still running rather than waiting for them.
+                            for other in running:
+                                other.cancel()
+        finally:
+            for task in running:
+                task.cancel()
+            if len(running) > 0:
+                await asyncio.gather(*running, return_exceptions=True)
+            if process_pool is not None:
+                process_pool.shutdown(wait=True)
+
+        if error is not None:
+            raise error
+
+    def _selectGraphNodes(self) -> bytearray:
+        graph = self.graph
+        selected = bytearray(graph.entered)
+        if self.dot_dirty_only:
+            for node in range(len(graph)):
+                selected[node] = selected[node] and graph.needs_to_build[node]
+
+        if self.dot_targets is not None:
+            # Breadth first through the prerequisites, up to dot_hops edges from the targets.
+            near = bytearray(len(graph))
+            frontier = [graph.ids[target] for target in self.dot_targets if target in self.build_tree]
+            hops = 0
+            while len(frontier) > 0:
+                next_frontier = []
+                for node in frontier:
+                    if near[node]:
+                        continue
+                    near[node] = 1
+                    if self.dot_hops is None or hops < self.dot_hops:
+                        next_frontier.extend(graph.prerequisites(node))
+                frontier = next_frontier
+                hops += 1
+            for node in range(len(graph)):
+                selected[node] = selected[node] and near[node]
+
+        if self.dot_critical_path:
+            # The rule with the longest expected time to the end of the build, then at each step the
+            # dependant that the priority came from.
+            on_path = bytearray(len(graph))
+            pending = [node for node in range(len(self.status)) if graph.entered[node] and self.status[node] == PENDING]
+            node = max(pending, key=lambda node: self.priorities[node], default=None)
+            while node is not None:
+                on_path[node] = 1
+                node = max(self._dependantsOf(node), key=lambda dep: self.priorities[dep], default=None)
+            for node in range(len(graph)):
+                selected[node] = selected[node] and on_path[node]
+        return selected
+
+    def _graphLabel(self, node: int) -> Optional[str]:
+        name = self.graph.getName(node)
+        if self.dot_rename_func is not None:
+            return self.dot_rename_func(name)
+        return name
+
+    def _drawGraph(self) -> None:
+        # Streams the selected part of the graph to the file, node numbers are the graph's own.
+        graph = self.graph
+        selected = self._selectGraphNodes()
+        graph_format = self.dot_format
+        if graph_format is None:
+            graph_format = {'.json': 'json', '.graphml': 'graphml'}.get(os.path.splitext(self.dot_file_name)[1], 'dot')
 
         with open(self.dot_file_name, 'w') as fle:
-            for line in lines:
-                fle.write(line+'\n')
+            if graph_format == 'dot':
+                fle.write('digraph build_tree {\n')
+                fle.write('graph [rankdir="LR"]\n')
+                for node in range(len(graph)):
+                    if not selected[node]:
+                        continue
+                    label = self._graphLabel(node)
+                    if label is not None:
+                        fle.write('node_%s [label="%s"]\n' % (node, label.replace('"', '\\"')))
+                    for dep in graph.prerequisites(node):
+                        if selected[dep]:
+                            fle.write('node_%s -> node_%s\n' % (dep, node))
+                fle.write('}\n')
+
+            elif graph_format == 'json':
+                fle.write('{"nodes": [')
+                separator = '\n'
+                for node in range(len(graph)):
+                    if selected[node]:
+                        fle.write(separator + json.dumps({'id': node, 'name': self._graphLabel(node), 'needs_to_build': bool(graph.needs_to_build[node])}))
+                        separator = ',\n'
+                fle.write('],\n"edges": [')
+                separator = '\n'
+                for node in range(len(graph)):
+                    if selected[node]:
+                        for dep in graph.prerequisites(node):
+                            if selected[dep]:
+                                fle.write('%s[%s, %s]' % (separator, dep, node))
+                                separator = ',\n'
+                fle.write(']}\n')
+
+            elif graph_format == 'graphml':
+                fle.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                fle.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+                fle.write('<key id="name" for="node" attr.name="name" attr.type="string"/>\n')
+                fle.write('<key id="needs_to_build" for="node" attr.name="needs_to_build" attr.type="boolean"/>\n')
+                fle.write('<graph id="build_tree" edgedefault="directed">\n')
+                for node in range(len(graph)):
+                    if selected[node]:
+                        fle.write('<node id="n%s"><data key="name">%s</data><data key="needs_to_build">%s</data></node>\n' % (
+                            node, escape(self._graphLabel(node) or ''), 'true' if graph.needs_to_build[node] else 'false'))
+                for node in range(len(graph)):
+                    if selected[node]:
+                        for dep in graph.prerequisites(node):
+                            if selected[dep]:
+                                fle.write('<edge source="n%s" target="n%s"/>\n' % (dep, node))
+                fle.write('</graph>\n</graphml>\n')
+
+            else:
+                raise ValueError("Unknown graph format %s." % graph_format)
+
 
 
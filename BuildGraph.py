@@ -0,0 +1,231 @@
+from array import array
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymake.builderrors import NoRuleError
+
+Rule = Any
+
+FORCED = 'forced'
+INTERRUPTED = 'interrupted'
+DISCOVERED_MISSING = 'discovered missing'
+PREREQUISITES_CHANGED = 'prerequisites changed'
+SETTINGS_CHANGED = 'settings changed'
+MISSING_OUTPUT = 'missing output'
+NEWER_SETTING = 'newer setting'
+NEWER_PREREQUISITE = 'newer prerequisite'
+PREREQUISITE_REBUILT = 'prerequisite rebuilt'
+
+def _formatTime(time: int) -> str:
+    if time < 0:
+        return 'never'
+    return datetime.fromtimestamp(time / 1e9).isoformat()
+
+class Reason:
+    # Why a node needs building. name is the prerequisite or setting that caused it, if any, and
+    # time and target_time are the nanosecond times that were compared: the prerequisite's or
+    # setting's, and the node's own last build.
+    __slots__ = ('kind', 'name', 'time', 'target_time')
+
+    def __init__(self, kind: str, name: Optional[str] = None, time: int = -1, target_time: int = -1):
+        self.kind = kind
+        self.name = name
+        self.time = time
+        self.target_time = target_time
+
+    def __repr__(self) -> str:
+        return 'Reason(%r, %r, %r, %r)' % (self.kind, self.name, self.time, self.target_time)
+
+    def __str__(self) -> str:
+        if self.kind == FORCED:
+            return 'the rule always rebuilds'
+        elif self.kind == INTERRUPTED:
+            return 'the last build did not finish it'
+        elif self.kind == DISCOVERED_MISSING:
+            return 'discovered dependency %s no longer exists' % self.name
+        elif self.kind == PREREQUISITES_CHANGED:
+            return 'prerequisite %s was added or removed' % self.name
+        elif self.kind == SETTINGS_CHANGED:
+            return 'setting %s changed at %s, the last build was at %s' % (self.name, _formatTime(self.time), _formatTime(self.target_time))
+        elif self.kind == MISSING_OUTPUT:
+            return 'the output does not exist'
+        elif self.kind == NEWER_SETTING:
+            return 'setting %s changed at %s, after the output was built at %s' % (self.name, _formatTime(self.time), _formatTime(self.target_time))
+        elif self.kind == NEWER_PREREQUISITE:
+            return 'prerequisite %s at %s is newer than the output at %s' % (self.name, _formatTime(self.time), _formatTime(self.target_time))
+        return 'prerequisite %s needs building' % self.name
+
+# Reasons without details are shared by every node they apply to.
+FORCED_REASON = Reason(FORCED)
+INTERRUPTED_REASON = Reason(INTERRUPTED)
+MISSING_OUTPUT_REASON = Reason(MISSING_OUTPUT)
+
+class BuildGraph:
+    # Nodes are rules, numbered in the order they are first reached, and every name of a rule maps to
+    # the same node. Per node state is kept in flat arrays and the prerequisites of each node are one
+    # slice of prerequisite_ids, so the graph holds no Python objects per edge. Node ids are 32 bit,
+    # edge offsets 64 bit.
+    # stale marks the nodes that need building whatever their prerequisites' new outputs turn out to be.
+    # reasons holds the Reason for every node that needs building.
+    __slots__ = ('ids', 'rules', 'entered', 'needs_to_build', 'stale', 'last_build_time',
+                 'prerequisite_start', 'prerequisite_end', 'prerequisite_ids', 'fingerprints',
+                 'reasons')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.ids: Dict[str, int] = {}
+        self.rules: List[Rule] = []
+        self.entered = bytearray()
+        self.needs_to_build = bytearray()
+        self.stale = bytearray()
+        self.last_build_time = array('q')
+        self.prerequisite_start = array('q')
+        self.prerequisite_end = array('q')
+        self.prerequisite_ids = array('i')
+        self.fingerprints: Dict[int, str] = {}
+        self.reasons: Dict[int, Reason] = {}
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def getNode(self, name: str, find_rule: Callable[[str], Optional[Rule]]) -> int:
+        node = self.ids.get(name)
+        if node is not None:
+            return node
+        rule = find_rule(name)
+        if rule is None:
+            raise NoRuleError(name)
+        return self.addNode(rule)
+
+    def addNode(self, rule: Rule) -> int:
+        node = len(self.rules)
+        for tgt in rule.names:
+            self.ids[tgt] = node
+        self.rules.append(rule)
+        self.entered.append(0)
+        self.needs_to_build.append(0)
+        self.stale.append(0)
+        self.last_build_time.append(-1)
+        self.prerequisite_start.append(0)
+        self.prerequisite_end.append(0)
+        return node
+
+    def setPrerequisites(self, node: int, prerequisites: List[int]) -> None:
+        # Re-entering a node after it was invalidated leaves its old slice unused.
+        self.prerequisite_start[node] = len(self.prerequisite_ids)
+        self.prerequisite_ids.extend(prerequisites)
+        self.prerequisite_end[node] = len(self.prerequisite_ids)
+
+    def prerequisites(self, node: int) -> array:
+        return self.prerequisite_ids[self.prerequisite_start[node]:self.prerequisite_end[node]]
+
+    def getName(self, node: int) -> str:
+        return self.rules[node].names[0]
+
+    def enteredNodes(self) -> Iterator[int]:
+        for node in range(len(self.rules)):
+            if self.entered[node]:
+                yield node
+
+    def reverseAdjacency(self, include: bytearray) -> Tuple[array, array]:
+        # Dependants of every included node as (offsets, ids), counting only edges between included nodes.
+        offsets = array('q', bytes(8 * (len(self.rules) + 1)))
+        for node in range(len(self.rules)):
+            if include[node]:
+                for dep in self.prerequisites(node):
+                    if include[dep]:
+                        offsets[dep + 1] += 1
+        for node in range(len(self.rules)):
+            offsets[node + 1] += offsets[node]
+
+        ids = array('i', bytes(4 * offsets[-1]))
+        fill = array('q', offsets)
+        for node in range(len(self.rules)):
+            if include[node]:
+                for dep in self.prerequisites(node):
+                    if include[dep]:
+                        ids[fill[dep]] = node
+                        fill[dep] += 1
+        return (offsets, ids)
+
+class NodeDetails:
+    # Read only view of one node, in the shape of the old build_tree entries.
+    __slots__ = ('graph', 'node')
+
+    def __init__(self, graph: BuildGraph, node: int):
+        self.graph = graph
+        self.node = node
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'needs_to_build':
+            return bool(self.graph.needs_to_build[self.node])
+        elif key == 'last_build_time':
+            return self.graph.last_build_time[self.node]
+        elif key == 'prerequisites':
+            return set(self.graph.rules[self.node].getPrerequisites())
+        elif key == 'settings_fingerprint':
+            return self.graph.fingerprints[self.node]
+        elif key == 'reason':
+            return self.graph.reasons.get(self.node)
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class BuildTreeView:
+    # Maps every name of every node reached by the last graph walk to its NodeDetails.
+    __slots__ = ('graph',)
+
+    def __init__(self, graph: BuildGraph):
+        self.graph = graph
+
+    def __contains__(self, name: str) -> bool:
+        node = self.graph.ids.get(name)
+        return node is not None and self.graph.entered[node] == 1
+
+    def __getitem__(self, name: str) -> NodeDetails:
+        if name not in self:
+            raise KeyError(name)
+        return NodeDetails(self.graph, self.graph.ids[name])
+
+    def __iter__(self) -> Iterator[str]:
+        for node in self.graph.enteredNodes():
+            yield from self.graph.rules[node].names
+
+    def __len__(self) -> int:
+        return sum([len(self.graph.rules[node].names) for node in self.graph.enteredNodes()])
+
+    def keys(self) -> Iterator[str]:
+        return iter(self)
+
+    def items(self) -> Iterator[Tuple[str, NodeDetails]]:
+        for node in self.graph.enteredNodes():
+            details = NodeDetails(self.graph, node)
+            for name in self.graph.rules[node].names:
+                yield (name, details)
+
+class NodeSetView:
+    # The names of the nodes whose status is the given value, as used for Build.built_rules.
+    __slots__ = ('graph', 'status', 'value')
+
+    def __init__(self, graph: BuildGraph, status: bytearray, value: int):
+        self.graph = graph
+        self.status = status
+        self.value = value
+
+    def __contains__(self, name: str) -> bool:
+        node = self.graph.ids.get(name)
+        return node is not None and node < len(self.status) and self.status[node] == self.value
+
+    def __iter__(self) -> Iterator[str]:
+        for node in range(len(self.status)):
+            if self.status[node] == self.value:
+                yield from self.graph.rules[node].names
+
+    def __len__(self) -> int:
+        return sum([len(self.graph.rules[node].names) for node in range(len(self.status)) if self.status[node] == self.value])
@@ -0,0 +1,71 @@
+from typing import Any, Dict, Iterable, Set
+import json
+import os
+
+class BuildJournal:
+    # An append only log of the rules a build starts, finishes and fails, one json object per line,
+    # so that a build that was killed can be resumed. A rule that was started or failed without
+    # finishing may have left a partly written output, and is rebuilt. A rule that finished has its
+    # record kept, for builds with a state file that was not saved.
+    def __init__(self, filename: str, sync: bool = False):
+        self.filename = filename
+        self.sync = sync
+        self.interrupted: Set[str] = set()
+        # The rules of this build that have started and not finished, and that have finished.
+        self.running: Set[str] = set()
+        self.finished: Set[str] = set()
+        self.completed: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as fle:
+                for line in fle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a killed build can be cut short.
+                        continue
+                    if entry['event'] == 'finish':
+                        self.interrupted.discard(entry['name'])
+                        self.completed[entry['name']] = entry
+                    else:
+                        self.interrupted.add(entry['name'])
+                        self.completed.pop(entry['name'], None)
+        self.fle = open(filename, 'a')
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        self.fle.write(json.dumps(entry) + '\n')
+        self.fle.flush()
+        if self.sync:
+            os.fsync(self.fle.fileno())
+
+    def start(self, name: str) -> None:
+        self.running.add(name)
+        self._write({'event': 'start', 'name': name})
+
+    def finish(self, name: str, record: Dict[str, Any]) -> None:
+        self.running.discard(name)
+        self.finished.add(name)
+        entry = {'event': 'finish', 'name': name}
+        entry.update(record)
+        self._write(entry)
+
+    def fail(self, name: str) -> None:
+        self.running.discard(name)
+        self._write({'event': 'fail', 'name': name})
+
+    def reset(self, failed: Iterable[str]) -> None:
+        # Called once the build's results are saved. The failed rules, any that were cancelled, and
+        # those an earlier build left unfinished that this one did not get to still have to be
+        # rebuilt, as their outputs could look up to date.
+        self.fle.close()
+        self.interrupted = (self.interrupted - self.finished) | set(failed) | self.running
+        with open(self.filename + '.tmp', 'w') as fle:
+            for name in sorted(self.interrupted):
+                fle.write(json.dumps({'event': 'fail', 'name': name}) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
+        self.running = set()
+        self.finished = set()
+        self.completed = {}
+        self.fle = open(self.filename, 'a')
+
+    def close(self) -> None:
+        self.fle.close()
@@ -0,0 +1,118 @@
+from typing import List, Dict, Optional, Set, Tuple
+import json
+import sqlite3
+
+from pymake.filehash import FileHashCache
+
+Record = Tuple[int, List[str], str]
+
+class BuildState:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS targets ('
+                'name TEXT PRIMARY KEY, '
+                'last_build_time INTEGER, '
+                'prerequisites TEXT, '
+                'settings_fingerprint TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS durations (name TEXT PRIMARY KEY, seconds REAL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS input_hashes (name TEXT PRIMARY KEY, hashes TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS discovered (name TEXT PRIMARY KEY, dependencies TEXT)')
+        self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS file_hashes ('
+                'path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime INTEGER, digest TEXT)')
+        self.records: Dict[str, Record] = {}
+        self.changed: Dict[str, Optional[Record]] = {}
+        for (name, last_build_time, prerequisites, fingerprint) in self.connection.execute('SELECT * FROM targets'):
+            self.records[name] = (last_build_time, json.loads(prerequisites), fingerprint)
+
+        self.durations: Dict[str, float] = {}
+        self.changed_durations: Set[str] = set()
+        for (name, seconds) in self.connection.execute('SELECT * FROM durations'):
+            self.durations[name] = seconds
+
+        self.input_hashes: Dict[str, Dict[str, str]] = {}
+        self.changed_input_hashes: Set[str] = set()
+        for (name, hashes) in self.connection.execute('SELECT * FROM input_hashes'):
+            self.input_hashes[name] = json.loads(hashes)
+
+        self.discovered: Dict[str, List[str]] = {}
+        self.changed_discovered: Set[str] = set()
+        for (name, dependencies) in self.connection.execute('SELECT * FROM discovered'):
+            self.discovered[name] = json.loads(dependencies)
+
+        self.file_hashes = FileHashCache()
+        for (path, inode, size, mtime, digest) in self.connection.execute('SELECT * FROM file_hashes'):
+            self.file_hashes.entries[path] = (inode, size, mtime, digest)
+
+    def getRecord(self, name: str) -> Optional[Record]:
+        return self.records.get(name)
+
+    def setRecord(self, name: str, last_build_time: int, prerequisites: List[str], settings_fingerprint: str) -> None:
+        record = (last_build_time, sorted(prerequisites), settings_fingerprint)
+        if self.records.get(name) != record:
+            self.records[name] = record
+            self.changed[name] = record
+
+    def removeRecord(self, name: str) -> None:
+        if name in self.records:
+            del self.records[name]
+            self.changed[name] = None
+        if name in self.input_hashes:
+            del self.input_hashes[name]
+            self.changed_input_hashes.add(name)
+
+    def setDuration(self, name: str, seconds: float) -> None:
+        self.durations[name] = seconds
+        self.changed_durations.add(name)
+
+    def getInputHashes(self, name: str) -> Dict[str, str]:
+        return self.input_hashes.get(name, {})
+
+    def setInputHashes(self, name: str, hashes: Dict[str, str]) -> None:
+        if self.input_hashes.get(name) != hashes:
+            self.input_hashes[name] = hashes
+            self.changed_input_hashes.add(name)
+
+    def setDiscovered(self, name: str, dependencies: List[str]) -> None:
+        if self.discovered.get(name) != dependencies:
+            self.discovered[name] = dependencies
+            self.changed_discovered.add(name)
+
+    def commit(self) -> None:
+        with self.connection:
+            for name, record in self.changed.items():
+                if record is None:
+                    self.connection.execute('DELETE FROM targets WHERE name = ?', (name,))
+                else:
+                    (last_build_time, prerequisites, fingerprint) = record
+                    self.connection.execute(
+                            'INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?)',
+                            (name, last_build_time, json.dumps(prerequisites), fingerprint))
+            for name in self.changed_durations:
+                self.connection.execute('INSERT OR REPLACE INTO durations VALUES (?, ?)', (name, self.durations[name]))
+            for name in self.changed_input_hashes:
+                if name in self.input_hashes:
+                    self.connection.execute(
+                            'INSERT OR REPLACE INTO input_hashes VALUES (?, ?)',
+                            (name, json.dumps(self.input_hashes[name])))
+                else:
+                    self.connection.execute('DELETE FROM input_hashes WHERE name = ?', (name,))
+            for name in self.changed_discovered:
+                self.connection.execute(
+                        'INSERT OR REPLACE INTO discovered VALUES (?, ?)',
+                        (name, json.dumps(self.discovered[name])))
+            for path in self.file_hashes.changed:
+                self.connection.execute(
+                        'INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)',
+                        (path, *self.file_hashes.entries[path]))
+        self.changed.clear()
+        self.changed_durations.clear()
+        self.changed_input_hashes.clear()
+        self.changed_discovered.clear()
+        self.file_hashes.changed.clear()
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
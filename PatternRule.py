@@ -0,0 +1,72 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymake.BaseRule import BaseRule
+
+Rule = Any
+
+class PatternRule:
+    # Describes a rule for every target matching a pattern such as build/%.o, where % matches any
+    # non empty stem. The prerequisite patterns have the same stem substituted in, and configure is
+    # called on each concrete rule, to set its recipe for example.
+    def __init__(self, patterns: List[str], rule_type = BaseRule, configure: Optional[Callable[[Rule, str], None]] = None):
+        for pattern in patterns:
+            assert pattern.count('%') == 1, "A pattern needs exactly one %%: %s." % pattern
+        self.patterns = patterns
+        self.rule_type = rule_type
+        self.configure = configure
+        self.prerequisites: List[str] = []
+        self.settings: List[str] = []
+
+    def addPrerequisite(self, prerequisite: str) -> None:
+        # A prerequisite without a % is the same for every target.
+        self.prerequisites.append(prerequisite)
+
+    def addSetting(self, setting: str) -> None:
+        self.settings.append(setting)
+
+    def getTargetNames(self, stem: str) -> List[str]:
+        return [pattern.replace('%', stem) for pattern in self.patterns]
+
+    def getPrerequisiteNames(self, stem: str) -> List[str]:
+        return [prerequisite.replace('%', stem) for prerequisite in self.prerequisites]
+
+    def materialise(self, stem: str) -> Rule:
+        rule = self.rule_type(self.getTargetNames(stem))
+        for prerequisite in self.getPrerequisiteNames(stem):
+            rule.addPrerequisite(prerequisite)
+        for setting in self.settings:
+            rule.addSetting(setting)
+        if self.configure is not None:
+            self.configure(rule, stem)
+        return rule
+
+class PatternIndex:
+    # Patterns are indexed by the text after the %, so finding the matches for a name costs one
+    # lookup per suffix length in use rather than a scan of every pattern.
+    def __init__(self):
+        self.by_suffix: Dict[str, List[Tuple[str, PatternRule]]] = {}
+        self.suffix_lengths: List[int] = []
+
+    def __len__(self) -> int:
+        return sum([len(entries) for entries in self.by_suffix.values()])
+
+    def add(self, pattern_rule: PatternRule) -> None:
+        for pattern in pattern_rule.patterns:
+            (prefix, suffix) = pattern.split('%')
+            self.by_suffix.setdefault(suffix, []).append((prefix, pattern_rule))
+            if len(suffix) not in self.suffix_lengths:
+                self.suffix_lengths.append(len(suffix))
+                self.suffix_lengths.sort()
+
+    def match(self, name: str) -> List[Tuple[str, PatternRule]]:
+        # The (stem, pattern rule) of every match, shortest stem first as in make.
+        matches = []
+        for length in self.suffix_lengths:
+            if length >= len(name):
+                break
+            suffix = name[len(name)-length:]
+            for (prefix, pattern_rule) in self.by_suffix.get(suffix, []):
+                if len(prefix) + length < len(name) and name.startswith(prefix):
+                    matches.append((name[len(prefix):len(name)-length], pattern_rule))
+        matches.sort(key=lambda match: len(match[0]))
+        return matches
@@ -0,0 +1,100 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import json
+
+class Profiler:
+    def __init__(self):
+        # (name, start, end)
+        self.phases: List[Tuple[str, datetime, datetime]] = []
+        # (rule names, start, end, cpu seconds, worker)
+        self.rules: List[Tuple[List[str], datetime, datetime, float, str]] = []
+        self.counters: Dict[str, float] = {}
+
+    def clear(self) -> None:
+        self.phases = []
+        self.rules = []
+        self.counters = {}
+
+    def addPhase(self, name: str, start_time: datetime, end_time: datetime) -> None:
+        self.phases.append((name, start_time, end_time))
+
+    def addRule(self, names: List[str], start_time: datetime, end_time: datetime, cpu_time: float, worker: str) -> None:
+        self.rules.append((list(names), start_time, end_time, cpu_time, worker))
+
+    def addCounter(self, name: str, value: float) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def getDurations(self) -> Dict[str, float]:
+        durations = {}
+        for (names, start_time, end_time, cpu_time, worker) in self.rules:
+            durations[names[0]] = (end_time - start_time).total_seconds()
+        return durations
+
+    def criticalPath(self, graph: Any) -> Tuple[List[str], float]:
+        # Longest chain of rule durations through the nodes of the build graph the last walk reached,
+        # including discovered dependencies, returned in build order.
+        durations = self.getDurations()
+        finish: Dict[int, float] = {}
+        previous: Dict[int, Optional[int]] = {}
+        for root in graph.enteredNodes():
+            if root in finish:
+                continue
+            stack = [root]
+            while len(stack) > 0:
+                node = stack[-1]
+                pending = [dep for dep in graph.prerequisites(node) if dep not in finish]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                if node in finish:
+                    continue
+                best = max(graph.prerequisites(node), key=lambda dep: finish[dep], default=None)
+                previous[node] = best
+                finish[node] = durations.get(graph.getName(node), 0.0) + (finish[best] if best is not None else 0.0)
+
+        if len(finish) == 0:
+            return ([], 0.0)
+        node = max(finish, key=lambda n: finish[n])
+        length = finish[node]
+        path = []
+        while node is not None:
+            path.append(graph.getName(node))
+            node = previous[node]
+        path.reverse()
+        return (path, length)
+
+    def exportChromeTrace(self, filename: str) -> None:
+        starts = [start_time for (_, start_time, _) in self.phases] + [start_time for (_, start_time, _, _, _) in self.rules]
+        if len(starts) == 0:
+            origin = datetime.now()
+        else:
+            origin = min(starts)
+
+        def micros(time: datetime) -> float:
+            return (time - origin).total_seconds() * 1e6
+
+        events = []
+        for (name, start_time, end_time) in self.phases:
+            events.append({'name': name, 'cat': 'phase', 'ph': 'X', 'pid': 0, 'tid': 'pymake',
+                           'ts': micros(start_time), 'dur': micros(end_time) - micros(start_time)})
+        for (names, start_time, end_time, cpu_time, worker) in self.rules:
+            events.append({'name': ', '.join(names), 'cat': 'rule', 'ph': 'X', 'pid': 0, 'tid': worker,
+                           'ts': micros(start_time), 'dur': micros(end_time) - micros(start_time),
+                           'args': {'cpu_time': cpu_time}})
+        for name, value in self.counters.items():
+            events.append({'name': name, 'cat': 'counter', 'ph': 'C', 'pid': 0, 'ts': 0, 'args': {name: value}})
+
+        with open(filename, 'w') as fle:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fle)
+
+    def summary(self) -> str:
+        lines = []
+        for (name, start_time, end_time) in self.phases:
+            lines.append('%s: %s' % (name, end_time - start_time))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%s: %s' % (name, value))
+        wall_time = sum([(end_time - start_time).total_seconds() for (_, start_time, end_time, _, _) in self.rules])
+        cpu_time = sum([cpu_time for (_, _, _, cpu_time, _) in self.rules])
+        lines.append('rules: %s, wall %.3fs, cpu %.3fs' % (len(self.rules), wall_time, cpu_time))
+        return '\n'.join(lines)
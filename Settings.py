@@ -1,38 +1,195 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Set, Tuple
+import hashlib
 import json
+import mmap
+import os
+import pickle
+import struct
 import time
 
 class SettingNotFoundError(Exception):
     def __init__(self, setting):
         Exception.__init__(self, "Could not find a value for setting %s." % setting)
 
+def _valueFingerprint(value: Any) -> str:
+    # Values that serialise the same have the same fingerprint, so a tuple that comes back from the
+    # settings file as a list is not a change.
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=repr).encode(), digest_size=16).hexdigest()
+
+# The binary settings file is a header holding the offset of the index, the pickled values, and the
+# index of name, value offset and length, date and fingerprint for every setting. A save appends the
+# changed values and a new index, and then points the header at it, so a save that is interrupted
+# leaves the old index in place. Unpickling can run arbitrary code, so binary settings files must
+# only be loaded from where the build scripts themselves are trusted.
+MAGIC = b'PYMKSET1'
+HEADER = struct.Struct('<8sQ')
+INDEX_ENTRY = struct.Struct('<HQQq16s')
+
 class Settings:
     def __init__(self):
         self.values = {}
         self.dates = {}
+        self.fingerprints = {}
+        # Combined fingerprints and change times of the setting name sets rules use, and the sets
+        # each name is part of so that they can be dropped when its value changes.
+        self.combined: Dict[Tuple[str, ...], Tuple[str, int]] = {}
+        self.combined_keys: Dict[str, Set[Tuple[str, ...]]] = {}
+        # Values from a binary settings file are only unpickled when they are asked for. encoded
+        # holds the offset and length in the mapped file of the values that have not changed since.
+        self.filename: Optional[str] = None
+        self.mapping: Optional[mmap.mmap] = None
+        self.encoded: Dict[str, Tuple[int, int]] = {}
+
+    def _closeMapping(self) -> None:
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def _mapFile(self, filename: str) -> None:
+        self._closeMapping()
+        self.filename = os.path.abspath(filename)
+        with open(filename, 'rb') as fle:
+            self.mapping = mmap.mmap(fle.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, index_offset) = HEADER.unpack_from(self.mapping, 0)
+        assert magic == MAGIC, "%s is not a binary settings file." % filename
+
+        self.values = {}
+        self.dates = {}
+        self.fingerprints = {}
+        self.encoded = {}
+        offset = index_offset
+        (count,) = struct.unpack_from('<I', self.mapping, offset)
+        offset += 4
+        for _ in range(count):
+            (name_length, value_offset, value_length, date, fingerprint) = INDEX_ENTRY.unpack_from(self.mapping, offset)
+            offset += INDEX_ENTRY.size
+            name = self.mapping[offset:offset+name_length].decode()
+            offset += name_length
+            self.encoded[name] = (value_offset, value_length)
+            self.dates[name] = date
+            self.fingerprints[name] = fingerprint.hex()
+
+    def _encodedValue(self, name: str) -> bytes:
+        if name in self.encoded:
+            (offset, length) = self.encoded[name]
+            return self.mapping[offset:offset+length]
+        return pickle.dumps(self.values[name], protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _writeIndex(self, fle, locations: Dict[str, Tuple[int, int]]) -> int:
+        index_offset = fle.tell()
+        parts = [struct.pack('<I', len(locations))]
+        for name, (offset, length) in locations.items():
+            encoded_name = name.encode()
+            parts.append(INDEX_ENTRY.pack(len(encoded_name), offset, length, self.dates[name], bytes.fromhex(self.fingerprints[name])))
+            parts.append(encoded_name)
+        fle.write(b''.join(parts))
+        return index_offset
+
+    def _appendValues(self, fle, names: List[str], locations: Dict[str, Tuple[int, int]]) -> None:
+        for name in names:
+            data = self._encodedValue(name)
+            locations[name] = (fle.tell(), len(data))
+            fle.write(data)
 
-    def serialise(self, filename: str) -> None:
+    def _saveBinary(self, filename: str) -> None:
+        locations = dict(self.encoded)
+        live_size = sum([length for (_, length) in locations.values()])
+        incremental = (self.mapping is not None and self.filename == os.path.abspath(filename) and
+                       os.path.exists(filename) and os.path.getsize(filename) == len(self.mapping) and
+                       len(self.mapping) < 2 * (live_size + HEADER.size) + (1 << 16))
+
+        changed = [name for name in self.fingerprints if name not in self.encoded]
+        if incremental and len(changed) == 0:
+            return
+        elif incremental:
+            # Only the changed values are written, then the header is switched to the new index.
+            with open(filename, 'r+b') as fle:
+                fle.seek(0, os.SEEK_END)
+                self._appendValues(fle, changed, locations)
+                index_offset = self._writeIndex(fle, locations)
+                fle.flush()
+                os.fsync(fle.fileno())
+                fle.seek(0)
+                fle.write(HEADER.pack(MAGIC, index_offset))
+                fle.flush()
+                os.fsync(fle.fileno())
+        else:
+            # Rewrites the whole file, copying the values that were never decoded as they are.
+            locations = {}
+            with open(filename + '.tmp', 'wb') as fle:
+                fle.write(HEADER.pack(MAGIC, 0))
+                self._appendValues(fle, list(self.fingerprints), locations)
+                index_offset = self._writeIndex(fle, locations)
+                fle.seek(0)
+                fle.write(HEADER.pack(MAGIC, index_offset))
+                fle.flush()
+                os.fsync(fle.fileno())
+            self._closeMapping()
+            os.replace(filename + '.tmp', filename)
+
+        # The values that are already decoded stay decoded.
+        values = self.values
+        self._mapFile(filename)
+        self.values = values
+
+    def serialise(self, filename: str, binary: bool = False) -> None:
+        # Json unless binary is set. The binary format only loads the values that are used and only
+        # writes the values that changed, for large settings, but see the warning above.
+        if binary:
+            self._saveBinary(filename)
+            return
         data = {
-                'values': self.values,
-                'dates': self.dates
+                'values': self.getValuesForNames(list(self.fingerprints)),
+                'dates': self.dates,
+                'fingerprints': self.fingerprints
                 }
-        json.dump(data, open(filename, 'w'))
+        if self.filename == os.path.abspath(filename):
+            # Every value is decoded now, and the mapped file is about to be replaced.
+            self._closeMapping()
+            self.filename = None
+            self.encoded = {}
+        with open(filename, 'w') as fle:
+            json.dump(data, fle)
 
     def deserialise(self, filename: str) -> None:
-        data = json.load( open(filename, 'r') )
+        with open(filename, 'rb') as fle:
+            magic = fle.read(len(MAGIC))
+        self.combined = {}
+        self.combined_keys = {}
+        if magic == MAGIC:
+            self._mapFile(filename)
+            return
+
+        self._closeMapping()
+        self.filename = None
+        self.encoded = {}
+        with open(filename, 'r') as fle:
+            data = json.load(fle)
         self.values = data['values']
         self.dates = data['dates']
+        if 'fingerprints' in data:
+            self.fingerprints = data['fingerprints']
+        else:
+            self.fingerprints = {name: _valueFingerprint(value) for name, value in self.values.items()}
 
     def setValue(self, name: str, value: Any) -> None:
-        if name not in self.values or self.values[name] != value:
+        fingerprint = _valueFingerprint(value)
+        if self.fingerprints.get(name) != fingerprint:
             self.values[name] = value
+            self.encoded.pop(name, None)
             self.dates[name] = time.time_ns()
+            self.fingerprints[name] = fingerprint
+            for key in self.combined_keys.pop(name, set()):
+                self.combined.pop(key, None)
         else:
+            # The same content, keep the value that was there and its date.
             pass
 
     def getSettingValue(self, name: str) -> Any:
         if name not in self.values:
-            raise SettingNotFoundError(name)
+            if name not in self.encoded:
+                raise SettingNotFoundError(name)
+            self.values[name] = pickle.loads(self._encodedValue(name))
         return self.values[name]
 
     def getValuesForNames(self, names: List[str]) -> Dict[str, Any]:
@@ -41,12 +198,35 @@ class Settings:
             result[name] = self.getSettingValue(name)
         return result
 
+    def _getCombined(self, names: List[str]) -> Tuple[str, int]:
+        key = tuple(sorted(set(names)))
+        combined = self.combined.get(key)
+        if combined is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            last_change = -1
+            for name in key:
+                if name not in self.fingerprints:
+                    raise SettingNotFoundError(name)
+                hasher.update(('%s=%s;' % (name, self.fingerprints[name])).encode())
+                last_change = max(last_change, self.dates[name])
+            combined = (hasher.hexdigest(), last_change)
+            self.combined[key] = combined
+            for name in key:
+                self.combined_keys.setdefault(name, set()).add(key)
+        return combined
+
+    def getFingerprint(self, names: List[str]) -> str:
+        return self._getCombined(names)[0]
+
+    def getLastBuildTimeForNames(self, names: List[str]) -> int:
+        # The last time any of the settings changed, -1 for no settings.
+        return self._getCombined(names)[1]
+
     def exists(self, name: str) -> bool:
-        return name in self.values
+        return name in self.fingerprints
 
     def getLastBuildTime(self, name: str) -> int:
         if not self.exists(name):
             return -1
         return self.dates[name]
 
-
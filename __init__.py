@@ -4,5 +4,7 @@ from . import filerules
 from . import utilrules
 from .BaseRule import BaseRule
 from .Settings import Settings
+from .Profiler import Profiler
+from .PatternRule import PatternRule
 
-__all__ = ['Build', 'BaseRule', 'Settings', 'builderrors', 'filerules', 'utilrules']
+__all__ = ['Build', 'BaseRule', 'Settings', 'Profiler', 'PatternRule', 'builderrors', 'filerules', 'utilrules']
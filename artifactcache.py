@@ -0,0 +1,128 @@
+import os
+import struct
+from abc import ABC, abstractmethod
+import urllib.error
+import urllib.request
+import warnings
+from typing import List, Optional
+
+class ArtifactCache(ABC):
+    # Backends only store opaque blobs by key, packing and unpacking the outputs is done here.
+
+    @abstractmethod
+    def fetch(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def store(self, key: str, data: bytes) -> None:
+        pass
+
+    def restore(self, key: str, names: List[str]) -> bool:
+        data = self.fetch(key)
+        if data is None:
+            return False
+
+        contents = []
+        offset = 0
+        for _ in names:
+            (length,) = struct.unpack_from('<Q', data, offset)
+            offset += 8
+            contents.append(data[offset:offset+length])
+            offset += length
+
+        for name, content in zip(names, contents):
+            directory = os.path.dirname(name)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            with open(name, 'wb') as fle:
+                fle.write(content)
+        return True
+
+    def save(self, key: str, names: List[str]) -> None:
+        parts = []
+        for name in names:
+            with open(name, 'rb') as fle:
+                content = fle.read()
+            parts.append(struct.pack('<Q', len(content)))
+            parts.append(content)
+        self.store(key, b''.join(parts))
+
+class LocalArtifactCache(ArtifactCache):
+    def __init__(self, directory: str, max_size: Optional[int] = None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.total_size = 0
+        for path in self._entries():
+            self.total_size += os.stat(path).st_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self) -> List[str]:
+        entries = []
+        for sub_dir in os.scandir(self.directory):
+            if sub_dir.is_dir():
+                entries.extend(entry.path for entry in os.scandir(sub_dir.path) if not entry.name.endswith('.tmp'))
+        return entries
+
+    def fetch(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fle:
+                data = fle.read()
+        except FileNotFoundError:
+            return None
+        # The modification time doubles as the last use time for the LRU eviction.
+        os.utime(path)
+        return data
+
+    def store(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self.total_size -= os.stat(path).st_size
+        with open(path + '.tmp', 'wb') as fle:
+            fle.write(data)
+        os.replace(path + '.tmp', path)
+        self.total_size += len(data)
+        self._evict()
+
+    def _evict(self) -> None:
+        if self.max_size is None or self.total_size <= self.max_size:
+            return
+        entries = [(os.stat(path).st_mtime_ns, path) for path in self._entries()]
+        entries.sort()
+        for (_, path) in entries:
+            if self.total_size <= self.max_size:
+                break
+            self.total_size -= os.stat(path).st_size
+            os.remove(path)
+
+class HttpArtifactCache(ArtifactCache):
+    # A server that cannot be reached, or that fails, is warned about and treated as a miss, so the
+    # rule is built instead.
+    def __init__(self, url: str, timeout: float = 30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, key: str) -> Optional[bytes]:
+        try:
+            with urllib.request.urlopen('%s/%s' % (self.url, key), timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                warnings.warn('Could not fetch %s from the artifact cache at %s: %s' % (key, self.url, e))
+            return None
+        except OSError as e:
+            # URLError and timeouts are both OSErrors.
+            warnings.warn('Could not fetch %s from the artifact cache at %s: %s' % (key, self.url, e))
+            return None
+
+    def store(self, key: str, data: bytes) -> None:
+        request = urllib.request.Request('%s/%s' % (self.url, key), data=data, method='PUT')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except OSError as e:
+            warnings.warn('Could not store %s in the artifact cache at %s: %s' % (key, self.url, e))
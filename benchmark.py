@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+if __name__ == "__main__":
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from pymake import Build
+from pymake.filerules import FileExistsRule, FileTouchRule
+from pymake.filestat import active_stat_cache
+
+# Each generator creates size file rules in the directory, writes the source files to disk and
+# returns the name of the target to build.
+
+def _fileName(directory: str, i: int) -> str:
+    # At most 1000 files per directory, so that large graphs do not make huge directories.
+    return os.path.join(directory, str(i // 1000), 'n%s' % i)
+
+def _createFiles(build: Build, directory: str, size: int, sources: List[int]) -> List[FileTouchRule]:
+    for i in range(0, size, 1000):
+        os.makedirs(os.path.dirname(_fileName(directory, i)), exist_ok=True)
+    rules = []
+    is_source = set(sources)
+    for i in range(size):
+        if i in is_source:
+            rules.append(build.createRule(_fileName(directory, i), FileExistsRule))
+            open(_fileName(directory, i), 'w').close()
+        else:
+            rules.append(build.createRule(_fileName(directory, i), FileTouchRule))
+    return rules
+
+def chainGraph(build: Build, directory: str, size: int) -> str:
+    rules = _createFiles(build, directory, size, [0])
+    for i in range(1, size):
+        rules[i].addPrerequisite(rules[i-1])
+    return rules[-1].names[0]
+
+def fanGraph(build: Build, directory: str, size: int) -> str:
+    # One source fans out to every other file, and the last file depends on all of them.
+    rules = _createFiles(build, directory, size, [0])
+    for i in range(1, size-1):
+        rules[i].addPrerequisite(rules[0])
+        rules[-1].addPrerequisite(rules[i])
+    return rules[-1].names[0]
+
+def diamondGraph(build: Build, directory: str, size: int) -> str:
+    # A stack of diamonds, each joining two files that depend on the join of the diamond below.
+    rules = _createFiles(build, directory, size, [0])
+    for i in range(1, size):
+        if i % 3 == 0:
+            rules[i].addPrerequisite(rules[i-1])
+            rules[i].addPrerequisite(rules[i-2])
+        else:
+            rules[i].addPrerequisite(rules[i - i % 3])
+    return rules[-1].names[0]
+
+def layeredGraph(build: Build, directory: str, size: int, width: int = 100) -> str:
+    # Each file depends on two files from the layer below it.
+    rules = _createFiles(build, directory, size, list(range(min(width, size))))
+    top = build.createRule(os.path.join(directory, 'all'), FileTouchRule)
+    for i in range(size):
+        if i >= width:
+            rules[i].addPrerequisite(rules[i - width])
+            rules[i].addPrerequisite(rules[i - width + (i+1) % width])
+        if i >= size - width:
+            top.addPrerequisite(rules[i])
+    return top.names[0]
+
+def randomGraph(build: Build, directory: str, size: int, degree: int = 3, seed: int = 0) -> str:
+    # Every file after the first percent depends on up to degree random earlier files.
+    generator = random.Random(seed)
+    source_count = max(1, size // 100)
+    rules = _createFiles(build, directory, size, list(range(source_count)))
+    used = set()
+    for i in range(source_count, size):
+        for dep in set(generator.randrange(i) for _ in range(degree)):
+            rules[i].addPrerequisite(rules[dep])
+            used.add(dep)
+    top = build.createRule(os.path.join(directory, 'all'), FileTouchRule)
+    for i in range(size):
+        if i not in used:
+            top.addPrerequisite(rules[i])
+    return top.names[0]
+
+SHAPES: Dict[str, Callable[[Build, str, int], str]] = {
+    'chain': chainGraph,
+    'fan': fanGraph,
+    'diamond': diamondGraph,
+    'layered': layeredGraph,
+    'random': randomGraph,
+}
+
+def _timed(func: Callable[[], Any]) -> float:
+    start_time = time.perf_counter()
+    func()
+    return time.perf_counter() - start_time
+
+def _schedule(build: Build) -> None:
+    # Drains the ready queue marking every rule as built, without running any of them.
+    now = datetime.now()
+    leaves = build._findNextBuildTargets()
+    while len(leaves) > 0:
+        for leaf in leaves:
+            build._markBuilt(build.graph.rules[leaf], now, now, 0.0, 'cache')
+        leaves = build._findNextBuildTargets()
+
+def benchmarkGraph(shape: str, size: int, measure_memory: bool = True) -> Dict[str, Any]:
+    directory = tempfile.mkdtemp(prefix='pymake-benchmark-')
+    try:
+        build = Build()
+        target = SHAPES[shape](build, directory, size)
+        result: Dict[str, Any] = {'shape': shape, 'size': size, 'rules': len(build.rules)}
+
+        # The phases are run outside of Build.build, so the build's stat cache is made active here.
+        token = active_stat_cache.set(build.stat_cache)
+        try:
+            build.stat_cache.clear()
+            result['graph_seconds'] = _timed(lambda: build._computeBuildSubGraph(target))
+            build._initialiseReadyQueue()
+            result['schedule_seconds'] = _timed(lambda: _schedule(build))
+
+            if measure_memory:
+                build.graph.clear()
+                build.stat_cache.clear()
+                tracemalloc.start()
+                try:
+                    build._computeBuildSubGraph(target)
+                    build._initialiseReadyQueue()
+                    (result['graph_bytes'], result['peak_bytes']) = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+        finally:
+            active_stat_cache.reset(token)
+
+        result['build_seconds'] = _timed(lambda: build.build(target))
+        result['built'] = len(build.timings)
+        result['noop_seconds'] = _timed(lambda: build.build(target))
+        result['noop_built'] = len(build.timings)
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def _printResult(result: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+    line = '%-8s %9s' % (result['shape'], result['size'])
+    for key in ['graph_seconds', 'schedule_seconds', 'build_seconds', 'noop_seconds']:
+        line += ' %10.4f' % result[key]
+        if previous is not None and previous.get(key):
+            line += ' (%5.2fx)' % (result[key] / previous[key])
+    if 'graph_bytes' in result:
+        line += ' %10.1f' % (result['graph_bytes'] / 1e6)
+    print(line)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Time graph construction, scheduling and builds on synthetic graphs.')
+    parser.add_argument('--shapes', nargs='+', choices=sorted(SHAPES), default=sorted(SHAPES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Results file from an earlier run to compare the times against.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc pass.')
+    args = parser.parse_args(argv)
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as fle:
+            for result in json.load(fle)['results']:
+                previous[(result['shape'], result['size'])] = result
+
+    print('%-8s %9s %10s %10s %10s %10s %10s' % ('shape', 'size', 'graph s', 'schedule s', 'build s', 'no-op s', 'graph MB'))
+    results = []
+    for shape in args.shapes:
+        for size in args.sizes:
+            result = benchmarkGraph(shape, size, not args.no_memory)
+            results.append(result)
+            _printResult(result, previous.get((shape, size)))
+
+    if args.json is not None:
+        with open(args.json, 'w') as fle:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'time': datetime.now().isoformat(), 'results': results}, fle, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,9 @@ class NoRuleError(Exception):
         Exception.__init__(self, "No rule to build %s." % target)
 
 class CyclicGraphError(Exception):
-    def __init__(self, target, build_path):
-        Exception.__init__(self, "Cyclic dependency detected for %s: %s." % (target, ', '.join(build_path)))
+    def __init__(self, target, cycle):
+        Exception.__init__(self, "Cyclic dependency detected for %s: %s." % (target, ' -> '.join(cycle)))
+        self.cycle = cycle
 
 class NoSettingError(Exception):
     def __init__(self, setting):
@@ -0,0 +1,45 @@
+import hashlib
+import mmap
+import os
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from pymake.filestat import stat_cache
+
+MMAP_THRESHOLD = 1 << 22
+CHUNK_SIZE = 1 << 20
+# Files modified this recently may still change within the same mtime, so their hashes are not kept.
+RACY_WINDOW_NS = 2 * 10**9
+
+def hashFile(path: str) -> str:
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fle:
+        if os.fstat(fle.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(fle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                hasher.update(data)
+        else:
+            chunk = fle.read(CHUNK_SIZE)
+            while chunk:
+                hasher.update(chunk)
+                chunk = fle.read(CHUNK_SIZE)
+    return hasher.hexdigest()
+
+class FileHashCache:
+    def __init__(self):
+        # path -> (inode, size, mtime, digest)
+        self.entries: Dict[str, Tuple[int, int, int, str]] = {}
+        self.changed: Set[str] = set()
+
+    def getHash(self, path: str) -> Optional[str]:
+        stat = stat_cache.stat(path)
+        if stat is None:
+            return None
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return entry[3]
+
+        digest = hashFile(path)
+        if time.time_ns() - stat.st_mtime_ns > RACY_WINDOW_NS:
+            self.entries[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns, digest)
+            self.changed.add(path)
+        return digest
@@ -1,20 +1,112 @@
 import os
+import asyncio
 import copy
-from typing import List, Callable, Dict, Any
+import fnmatch
+import functools
+import hashlib
+import inspect
+import json
+import stat as stat_module
+import time
+import types
+from typing import List, Callable, Dict, Any, Optional, Tuple
 
 from pymake.BaseRule import BaseRule
+from pymake.builderrors import BuildError
+from pymake.filehash import FileHashCache
+from pymake.filestat import stat_cache
+
+def _codeIdentity(code) -> bytes:
+    # Unlike marshal this leaves out file names and line numbers, so the identity is the same on every machine.
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            parts.append(_codeIdentity(const))
+        else:
+            parts.append(repr(const).encode())
+    return b''.join(parts)
+
+def _codeNames(code) -> List[str]:
+    # The global and attribute names used by the code and the functions defined in it.
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            names.extend(_codeNames(const))
+    return names
+
+def _valueIdentity(value: Any, seen: Tuple[int, ...] = ()) -> Optional[bytes]:
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return repr(value).encode()
+    elif isinstance(value, (list, tuple)):
+        parts = [_valueIdentity(item, seen) for item in value]
+        if None in parts:
+            return None
+        return b'[' + b','.join(parts) + b']'
+    elif isinstance(value, dict):
+        parts = [(_valueIdentity(key, seen), _valueIdentity(item, seen)) for key, item in sorted(value.items(), key=lambda pair: repr(pair[0]))]
+        if None in [part for pair in parts for part in pair]:
+            return None
+        return b'{' + b','.join([key + b':' + item for (key, item) in parts]) + b'}'
+    elif isinstance(value, (set, frozenset)):
+        parts = [_valueIdentity(item, seen) for item in value]
+        if None in parts:
+            return None
+        return b'{' + b','.join(sorted(parts)) + b'}'
+    elif isinstance(value, types.ModuleType):
+        # Modules, classes and builtins are installed code rather than part of the build, so their name identifies them.
+        return b'module ' + value.__name__.encode()
+    elif isinstance(value, (type, types.BuiltinFunctionType)):
+        return ('%s.%s' % (value.__module__, value.__qualname__)).encode()
+    elif callable(value):
+        return _recipeIdentity(value, seen)
+    return None
+
+def _recipeIdentity(recipe: Callable, seen: Tuple[int, ...] = ()) -> Optional[bytes]:
+    # Everything that decides what a recipe does: its name and code, its default arguments, the values
+    # it closes over, the globals it uses and the arguments of partials. None when any of them is a value
+    # that cannot be identified, as a key that leaves it out could match a recipe that does something else.
+    if id(recipe) in seen:
+        # A function that refers to itself through its closure or globals.
+        return b'recursive'
+    seen = seen + (id(recipe),)
+    if isinstance(recipe, functools.partial):
+        func = _recipeIdentity(recipe.func, seen)
+        args = _valueIdentity([recipe.args, recipe.keywords], seen)
+        if func is None or args is None:
+            return None
+        return b'partial(' + func + b';' + args + b')'
+    code = getattr(recipe, '__code__', None)
+    if code is None:
+        return None
+    try:
+        cells = [cell.cell_contents for cell in recipe.__closure__ or ()]
+    except ValueError:
+        # A closure variable that has not been assigned yet.
+        return None
+    # Attribute names are in co_names too, and only the ones that are also globals are kept.
+    recipe_globals = getattr(recipe, '__globals__', {})
+    used_globals = {name: recipe_globals[name] for name in _codeNames(code) if name in recipe_globals}
+    values = _valueIdentity([recipe.__defaults__, recipe.__kwdefaults__, cells, used_globals], seen)
+    if values is None:
+        return None
+    name = ('%s.%s' % (getattr(recipe, '__module__', ''), getattr(recipe, '__qualname__', ''))).encode()
+    return name + b';' + _codeIdentity(code) + b';' + values
 
 def modtime(path):
-    return os.stat(path).st_mtime_ns
+    stat = stat_cache.stat(path)
+    if stat is None:
+        raise FileNotFoundError(path)
+    return stat.st_mtime_ns
 
 class FileExistsRule(BaseRule):
+    __slots__ = ()
 
     def __init__(self, names):
         BaseRule.__init__(self, names)
 
     def exists(self) -> bool:
         for name in self.names:
-            if not os.path.exists(name):
+            if not stat_cache.exists(name):
                 return False
         else:
             return True
@@ -24,7 +116,16 @@ class FileExistsRule(BaseRule):
             return -1
         return min([modtime(name) for name in self.names])
 
+    def getContentHash(self, hash_cache: FileHashCache) -> Optional[str]:
+        digests = [hash_cache.getHash(name) for name in self.names]
+        if None in digests:
+            return None
+        if len(digests) == 1:
+            return digests[0]
+        return hashlib.blake2b(''.join(digests).encode(), digest_size=20).hexdigest()
+
 class FileTouchRule(FileExistsRule):
+    __slots__ = ()
 
     def __init__(self, names):
         BaseRule.__init__(self, names)
@@ -36,23 +137,301 @@ class FileTouchRule(FileExistsRule):
                 fle.close()
         except:
             raise
+        finally:
+            stat_cache.invalidate(self.names)
+
+# A directory modified this close to the last scan may have changed again within the resolution of its
+# modification time, so it is listed again.
+DIRECTORY_TIME_MARGIN_NS = 50000000
+
+class DirectoryRule(FileExistsRule):
+    # A source rule for the files in a directory tree, optionally only those whose path relative to
+    # the directory matches a glob pattern. It counts as changed only when a file is added, removed
+    # or has a new size or modification time. The listing of every directory is kept in a manifest
+    # file between builds, and a directory whose modification time has not changed is not listed
+    # again. Its files are still stat'ed, as editing a file does not touch its directory, unless
+    # directory times are trusted because files are only ever replaced.
+    __slots__ = ('pattern', 'manifest_file', 'trust_directory_times', 'scanned_stat', 'files', 'directories', 'changed', 'listed')
+
+    def __init__(self, names):
+        FileExistsRule.__init__(self, names)
+        assert len(names) == 1, "A directory rule has one directory."
+        self.pattern = None
+        self.manifest_file = None
+        self.trust_directory_times = False
+        self.scanned_stat = None
+        self.files: Dict[str, List[int]] = {}
+        # The directories in the tree relative to it, '' for the directory itself.
+        self.directories: List[str] = []
+        self.changed = -1
+        # The number of directories the last scan listed.
+        self.listed = 0
+
+    def setPattern(self, pattern: Optional[str]) -> None:
+        # Matched with fnmatch against the path relative to the directory, so * also matches /.
+        self.pattern = pattern
+        self.scanned_stat = None
+
+    def setManifestFile(self, manifest_file: Optional[str]) -> None:
+        self.manifest_file = manifest_file
+        self.scanned_stat = None
+
+    def _manifestFile(self) -> str:
+        # By default next to the directory, named after it and the pattern, so that rules for the
+        # same directory with different patterns do not share a manifest.
+        if self.manifest_file is not None:
+            return self.manifest_file
+        root = os.path.abspath(self.names[0])
+        name = '.%s.manifest' % os.path.basename(root)
+        if self.pattern is not None:
+            name = '.%s.%s.manifest' % (os.path.basename(root), hashlib.blake2b(self.pattern.encode(), digest_size=8).hexdigest())
+        return os.path.join(os.path.dirname(root), name)
+
+    def setTrustDirectoryTimes(self, trust_directory_times: bool) -> None:
+        self.trust_directory_times = trust_directory_times
+
+    def exists(self) -> bool:
+        stat = stat_cache.stat(self.names[0])
+        return stat is not None and stat_module.S_ISDIR(stat.st_mode)
+
+    def _loadManifest(self) -> Dict[str, Any]:
+        try:
+            with open(self._manifestFile()) as fle:
+                manifest = json.load(fle)
+            if manifest.get('pattern') == self.pattern:
+                return manifest
+        except (FileNotFoundError, ValueError):
+            pass
+        return {'pattern': self.pattern, 'changed': -1, 'scanned': -1, 'directories': {}}
+
+    def _listDirectory(self, path: str, previous: Optional[Dict[str, Any]], mtime: int, scanned: int) -> Tuple[List[str], Dict[str, List[int]]]:
+        if previous is not None and previous['mtime'] == mtime and mtime + DIRECTORY_TIME_MARGIN_NS < scanned:
+            if self.trust_directory_times:
+                return (previous['directories'], previous['files'])
+            files = {}
+            for name in previous['files']:
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except FileNotFoundError:
+                    continue
+                files[name] = [stat.st_size, stat.st_mtime_ns]
+            return (previous['directories'], files)
+
+        self.listed += 1
+        directories = []
+        files = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.name)
+                    else:
+                        stat = entry.stat()
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+                except FileNotFoundError:
+                    # Removed while listing, or a broken link.
+                    pass
+        return (sorted(directories), files)
+
+    def _matchingFiles(self, directories: Dict[str, Any]) -> Dict[str, List[int]]:
+        files = {}
+        for relative_directory, listing in directories.items():
+            for name, details in listing['files'].items():
+                path = name if relative_directory == '' else relative_directory + '/' + name
+                if self.pattern is None or fnmatch.fnmatchcase(path, self.pattern):
+                    files[path] = details
+        return files
+
+    def _scan(self) -> None:
+        manifest = self._loadManifest()
+        scan_start = time.time_ns()
+        self.listed = 0
+        directories = {}
+        stack = ['']
+        while len(stack) > 0:
+            relative_directory = stack.pop()
+            path = self.names[0] if relative_directory == '' else os.path.join(self.names[0], relative_directory)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                (subdirectories, files) = self._listDirectory(path, manifest['directories'].get(relative_directory), mtime, manifest['scanned'])
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            directories[relative_directory] = {'mtime': mtime, 'directories': subdirectories, 'files': files}
+            for name in subdirectories:
+                stack.append(name if relative_directory == '' else relative_directory + '/' + name)
+
+        self.files = self._matchingFiles(directories)
+        self.directories = sorted(directories)
+        if self.files != self._matchingFiles(manifest['directories']) or manifest['changed'] < 0:
+            self.changed = scan_start
+        else:
+            self.changed = manifest['changed']
+        if self.listed > 0 or directories != manifest['directories'] or self.changed != manifest['changed']:
+            # Saved as soon as it is scanned, the change time is kept so that a build that fails
+            # after this still rebuilds the rules that depend on the directory.
+            manifest_file = self._manifestFile()
+            with open(manifest_file + '.tmp', 'w') as fle:
+                json.dump({'pattern': self.pattern, 'changed': self.changed, 'scanned': scan_start, 'directories': directories}, fle)
+            os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _update(self) -> None:
+        # Scans once for every stat of the directory, so again on each build that clears the stat cache.
+        stat = stat_cache.stat(self.names[0])
+        if stat is not self.scanned_stat:
+            self.scanned_stat = stat
+            if stat is None:
+                self.files = {}
+                self.directories = []
+                self.changed = -1
+            else:
+                self._scan()
+
+    def getFiles(self) -> List[str]:
+        self._update()
+        return [os.path.join(self.names[0], path) for path in sorted(self.files)]
+
+    def getDirectories(self) -> List[str]:
+        self._update()
+        return [os.path.join(self.names[0], path) for path in self.directories]
+
+    def getLastBuildTime(self) -> int:
+        # When the files last changed, as seen by a scan.
+        self._update()
+        return self.changed
+
+    def getContentHash(self, hash_cache: FileHashCache) -> Optional[str]:
+        self._update()
+        return hashlib.blake2b(json.dumps(self.files, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+def parseDepfile(text: str) -> List[str]:
+    # Reads the prerequisites from a make style depfile, as written by gcc -MD, of the form
+    # "target: dep dep \" with continued lines, spaces escaped as "\ " and dollars as "$$".
+    dependencies = []
+    text = text.replace('\\\n', ' ').replace('\\\r\n', ' ')
+    for line in text.splitlines():
+        words = []
+        word = ''
+        i = 0
+        while i < len(line):
+            char = line[i]
+            if char == '\\' and i + 1 < len(line) and line[i+1] in ' #\\':
+                word += line[i+1]
+                i += 2
+                continue
+            if char == '$' and line[i+1:i+2] == '$':
+                word += '$'
+                i += 2
+                continue
+            if char in ' \t':
+                if word != '':
+                    words.append(word)
+                word = ''
+            else:
+                word += char
+            i += 1
+        if word != '':
+            words.append(word)
+
+        # Everything up to the word ending in a colon is the targets.
+        for index, word in enumerate(words):
+            if word.endswith(':'):
+                dependencies.extend(words[index+1:])
+                break
+    return dependencies
 
 class GenericFileRule(FileTouchRule):
+    __slots__ = ('recipe', 'depfile')
 
     def __init__(self, names):
         FileTouchRule.__init__(self, names)
-        self.recipy = None
+        self.recipe = None
+        self.depfile = None
 
-    def setRecipe(self, recipe: Callable[[str, List[str]], None]) -> None:
+    def setRecipe(self, recipe: Callable[[str, List[str]], Optional[List[str]]]) -> None:
+        # The recipe may return the files it read beyond its prerequisites.
         self.recipe = recipe
 
-    def build(self, settings_values: Dict[str, Any]) -> None:
+    def setDepfile(self, depfile: Optional[str]) -> None:
+        # A make style depfile that the recipe writes, listing the files it read.
+        self.depfile = depfile
+
+    def _discovered(self, returned: Any) -> Optional[List[str]]:
+        if returned is None and self.depfile is None:
+            return None
+        dependencies = list(returned or [])
+        if self.depfile is not None:
+            with open(self.depfile) as fle:
+                dependencies.extend(parseDepfile(fle.read()))
+        known = set(self.names) | set(self.prerequisites)
+        return [dep for dep in dict.fromkeys(dependencies) if dep not in known]
+
+    def getCacheKey(self, settings_values: Dict[str, Any], input_hashes: Dict[str, Optional[str]]) -> Optional[str]:
+        if self.recipe is None or None in input_hashes.values():
+            return None
+        identity = _recipeIdentity(self.recipe)
+        if identity is None:
+            return None
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(identity)
+        hasher.update(json.dumps([self.names, self.prerequisites, input_hashes, settings_values], sort_keys=True, default=repr).encode())
+        return hasher.hexdigest()
+
+    def _recipeArgs(self) -> List[Any]:
+        if len(self.names) == 1:
+            return [self.names[0], copy.copy(self.prerequisites)]
+        else:
+            return [copy.copy(self.names), copy.copy(self.prerequisites)]
+
+    def build(self, settings_values: Dict[str, Any]) -> Optional[List[str]]:
         try:
-            if len(self.names) == 1:
-                self.recipe(self.names[0], copy.copy(self.prerequisites), settings_values)
+            if inspect.iscoroutinefunction(self.recipe):
+                returned = asyncio.run(self.recipe(*self._recipeArgs(), settings_values))
             else:
-                self.recipe(copy.copy(self.names), copy.copy(self.prerequisites), settings_values)
+                returned = self.recipe(*self._recipeArgs(), settings_values)
+            stat_cache.invalidate(self.names)
             assert self.exists(), 'The file %s should exist after the rule ran.' % (', '.join(self.names))
+            return self._discovered(returned)
         except:
             print('Error when building: %s' % (', '.join(self.names)))
             raise
+
+    async def buildAsync(self, settings_values: Dict[str, Any]) -> Optional[List[str]]:
+        if not inspect.iscoroutinefunction(self.recipe):
+            return await FileTouchRule.buildAsync(self, settings_values)
+        try:
+            returned = await self.recipe(*self._recipeArgs(), settings_values)
+            stat_cache.invalidate(self.names)
+            assert self.exists(), 'The file %s should exist after the rule ran.' % (', '.join(self.names))
+            return self._discovered(returned)
+        except asyncio.CancelledError:
+            raise
+        except:
+            print('Error when building: %s' % (', '.join(self.names)))
+            raise
+
+def commandRecipe(command: List[str]) -> Callable:
+    # Makes a recipe that runs a command as a subprocess. Each argument is formatted with the target
+    # and the settings values. An argument that is exactly {target} or {prerequisites} is replaced by
+    # all of the targets or prerequisites.
+    async def recipe(target: Any, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+        targets = target if isinstance(target, list) else [target]
+        args = []
+        for arg in command:
+            if arg == '{prerequisites}':
+                args.extend(prerequisites)
+            elif arg == '{target}':
+                args.extend(targets)
+            else:
+                args.append(arg.format(target=targets[0], **settings_values))
+
+        process = await asyncio.create_subprocess_exec(*args)
+        try:
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if return_code != 0:
+            raise BuildError('Command failed with exit code %s: %s' % (return_code, ' '.join(args)))
+
+    return recipe
@@ -0,0 +1,93 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+class StatCache:
+    def __init__(self):
+        # path -> stat result, or None when the path does not exist
+        self.stats: Dict[str, Optional[os.stat_result]] = {}
+        self.stat_calls = 0
+        self.stat_time_ns = 0
+
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        if path in self.stats:
+            return self.stats[path]
+        self.stat_calls += 1
+        start_time = time.perf_counter_ns()
+        try:
+            result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            result = None
+        self.stat_time_ns += time.perf_counter_ns() - start_time
+        self.stats[path] = result
+        return result
+
+    def exists(self, path: str) -> bool:
+        return self.stat(path) is not None
+
+    def knownMissing(self, paths: Iterable[str]) -> bool:
+        # Whether any of the paths has already been found not to exist, without a stat for the others.
+        return any(path in self.stats and self.stats[path] is None for path in paths)
+
+    def invalidate(self, paths: Iterable[str]) -> None:
+        for path in paths:
+            self.stats.pop(path, None)
+
+    def clear(self) -> None:
+        self.stats.clear()
+        self.stat_calls = 0
+        self.stat_time_ns = 0
+
+    def _scanDirectory(self, directory: str, paths: List[str]) -> None:
+        # Listing the directory finds the missing paths without a failed stat for each of them.
+        start_time = time.perf_counter_ns()
+        entries = {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    entries[entry.name] = entry
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        for path in paths:
+            entry = entries.get(os.path.basename(path))
+            if entry is None:
+                self.stats[path] = None
+                continue
+            self.stat_calls += 1
+            try:
+                self.stats[path] = entry.stat()
+            except FileNotFoundError:
+                self.stats[path] = None
+        self.stat_time_ns += time.perf_counter_ns() - start_time
+
+    def prefetch(self, paths: Iterable[str], threads: int = 1) -> None:
+        directories: Dict[str, List[str]] = {}
+        for path in paths:
+            if path in self.stats:
+                continue
+            if os.path.basename(path) == '':
+                self.stat(path)
+                continue
+            directories.setdefault(os.path.dirname(path) or '.', []).append(path)
+
+        if threads <= 1:
+            for directory, dir_paths in directories.items():
+                self._scanDirectory(directory, dir_paths)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for _ in executor.map(lambda item: self._scanDirectory(*item), directories.items()):
+                    pass
+
+# Each Build has its own StatCache and makes it the active one while it runs, in its thread and in
+# the threads it runs rules in, so two builds, or a build started from a recipe, do not clear or fill
+# each other's cache. Outside of a build a cache shared by the process is used.
+active_stat_cache: ContextVar[StatCache] = ContextVar('active_stat_cache', default=StatCache())
+
+class _ActiveStatCache:
+    # Stands for the active stat cache, for the rules, which are not given one.
+    def __getattr__(self, name: str):
+        return getattr(active_stat_cache.get(), name)
+
+stat_cache = _ActiveStatCache()
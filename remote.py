@@ -0,0 +1,292 @@
+import argparse
+import collections
+import contextvars
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+if __name__ == "__main__":
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from pymake.builderrors import BuildError
+from pymake.filehash import FileHashCache, hashFile
+from pymake.filestat import stat_cache
+
+# Messages are pickled and sent with a length prefix. Pickles can run arbitrary code when loaded,
+# as can the recipes the workers run, so workers must only be reachable from trusted machines.
+
+Address = Tuple[str, int]
+
+def _send(connection: socket.socket, message: Any) -> None:
+    data = pickle.dumps(message)
+    connection.sendall(struct.pack('<Q', len(data)) + data)
+
+def _receiveExactly(connection: socket.socket, length: int) -> bytes:
+    parts = []
+    while length > 0:
+        part = connection.recv(min(length, 1 << 20))
+        if len(part) == 0:
+            raise ConnectionError('Connection closed.')
+        parts.append(part)
+        length -= len(part)
+    return b''.join(parts)
+
+def _receive(connection: socket.socket) -> Any:
+    (length,) = struct.unpack('<Q', _receiveExactly(connection, 8))
+    return pickle.loads(_receiveExactly(connection, length))
+
+class RemoteWorker:
+    # Runs one rule at a time in its work directory. Uploaded files are kept by content hash, so an
+    # input only has to be sent to each worker once.
+    def __init__(self, directory: str):
+        self.blob_directory = os.path.join(directory, 'blobs')
+        self.work_directory = os.path.join(directory, 'work')
+        os.makedirs(self.blob_directory, exist_ok=True)
+        os.makedirs(self.work_directory, exist_ok=True)
+
+    def _blobPath(self, digest: str) -> str:
+        return os.path.join(self.blob_directory, digest)
+
+    def _materialise(self, inputs: Dict[str, str]) -> None:
+        for path, digest in inputs.items():
+            if os.path.exists(path) and hashFile(path) == digest:
+                continue
+            directory = os.path.dirname(path)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            with open(self._blobPath(digest), 'rb') as source:
+                with open(path, 'wb') as fle:
+                    fle.write(source.read())
+
+    def _run(self, func: Callable, args: Tuple[Any, ...], inputs: Dict[str, str], outputs: List[str]) -> Any:
+        try:
+            self._materialise(inputs)
+            # Files here change between jobs without this process writing them.
+            stat_cache.clear()
+            result = func(*args)
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+                return ('failed', e)
+            except Exception:
+                return ('failed', BuildError(repr(e)))
+
+        contents = {}
+        for name in outputs:
+            if os.path.isfile(name):
+                with open(name, 'rb') as fle:
+                    contents[name] = fle.read()
+        return ('done', result, contents)
+
+    def handle(self, connection: socket.socket) -> None:
+        while True:
+            try:
+                message = _receive(connection)
+            except ConnectionError:
+                return
+            if message[0] == 'has':
+                _send(connection, ('missing', [digest for digest in message[1] if not os.path.exists(self._blobPath(digest))]))
+            elif message[0] == 'put':
+                for digest, content in message[1].items():
+                    with open(self._blobPath(digest) + '.tmp', 'wb') as fle:
+                        fle.write(content)
+                    os.replace(self._blobPath(digest) + '.tmp', self._blobPath(digest))
+            elif message[0] == 'run':
+                (_, func, args, inputs, outputs) = message
+                _send(connection, self._run(func, args, inputs, outputs))
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0, ready: Optional[Callable[[Address], None]] = None) -> None:
+        # Relative paths in the rules are relative to the work directory.
+        os.chdir(self.work_directory)
+        with socket.create_server((host, port)) as server:
+            if ready is not None:
+                ready(server.getsockname()[:2])
+            while True:
+                (connection, _) = server.accept()
+                with connection:
+                    self.handle(connection)
+
+class _Job:
+    __slots__ = ('future', 'func', 'args', 'context')
+
+    def __init__(self, future: Future, func: Callable, args: Tuple[Any, ...]):
+        self.future = future
+        self.func = func
+        self.args = args
+        # The job is uploaded in the context it was created in, so that it uses the stat cache of
+        # the build that submitted it rather than the process wide one, which no build clears.
+        self.context = contextvars.copy_context()
+
+class _WorkerConnection:
+    def __init__(self, address: Address):
+        self.address = address
+        self.connection = socket.create_connection(address)
+        # Digests the worker is known to have, so they are not even asked about again.
+        self.known: Set[str] = set()
+        self.queue: Deque[_Job] = collections.deque()
+        self.alive = True
+
+class RemoteExecutor(Executor):
+    # Runs rules on remote workers, for use with Build.addExecutor. Submitted calls must take the
+    # rule as their first argument: its prerequisite files are uploaded to the worker and its
+    # output files are copied back before the future completes. Files a recipe reads without
+    # declaring them must be on a file system the workers share.
+    #
+    # Each worker has its own queue. New jobs go to the shortest queue and a worker with nothing
+    # queued steals the newest job from the longest queue.
+    def __init__(self, addresses: List[Address]):
+        self.hashes = FileHashCache()
+        self.uploads = 0
+        self.condition = threading.Condition()
+        self.shutting_down = False
+        self.workers = [_WorkerConnection(address) for address in addresses]
+        self.threads = []
+        for worker in self.workers:
+            thread = threading.Thread(target=self._workerLoop, args=(worker,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn: Callable, *args: Any, **kwargs: Any) -> Future:
+        assert len(kwargs) == 0, "Remote calls only take positional arguments."
+        future = Future()
+        with self.condition:
+            if self.shutting_down:
+                raise RuntimeError('Cannot submit to an executor that has been shut down.')
+            live = [worker for worker in self.workers if worker.alive]
+            if len(live) == 0:
+                raise BuildError('No remote workers are available.')
+            min(live, key=lambda worker: len(worker.queue)).queue.append(_Job(future, fn, args))
+            self.condition.notify_all()
+        return future
+
+    def _nextJob(self, worker: _WorkerConnection) -> Optional[_Job]:
+        with self.condition:
+            while True:
+                if len(worker.queue) > 0:
+                    return worker.queue.popleft()
+                victim = max(self.workers, key=lambda other: len(other.queue))
+                if len(victim.queue) > 0:
+                    return victim.queue.pop()
+                if self.shutting_down:
+                    return None
+                self.condition.wait()
+
+    def _upload(self, worker: _WorkerConnection, paths: List[str]) -> Dict[str, str]:
+        inputs = {}
+        for path in paths:
+            if os.path.isfile(path):
+                inputs[path] = self.hashes.getHash(path)
+        unknown = sorted(set(inputs.values()) - worker.known)
+        if len(unknown) > 0:
+            _send(worker.connection, ('has', unknown))
+            (_, missing) = _receive(worker.connection)
+            if len(missing) > 0:
+                by_digest = {digest: path for path, digest in inputs.items()}
+                blobs = {}
+                for digest in missing:
+                    with open(by_digest[digest], 'rb') as fle:
+                        blobs[digest] = fle.read()
+                self.uploads += len(blobs)
+                _send(worker.connection, ('put', blobs))
+            worker.known.update(unknown)
+        return inputs
+
+    def _runJob(self, worker: _WorkerConnection, job: _Job) -> None:
+        rule = job.args[0]
+        inputs = self._upload(worker, list(rule.getPrerequisites()))
+        _send(worker.connection, ('run', job.func, job.args, inputs, list(rule.names)))
+        reply = _receive(worker.connection)
+        if reply[0] == 'failed':
+            job.future.set_exception(reply[1])
+            return
+
+        (_, result, contents) = reply
+        for name, content in contents.items():
+            directory = os.path.dirname(name)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            with open(name, 'wb') as fle:
+                fle.write(content)
+        job.future.set_result(result)
+
+    def _workerLoop(self, worker: _WorkerConnection) -> None:
+        while True:
+            job = self._nextJob(worker)
+            if job is None:
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                job.context.run(self._runJob, worker, job)
+            except (ConnectionError, OSError) as e:
+                job.future.set_exception(BuildError('Lost remote worker %s:%s: %s' % (*worker.address, e)))
+                self._dropWorker(worker)
+                return
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def _dropWorker(self, worker: _WorkerConnection) -> None:
+        # Its queued jobs move to the other workers, or fail if there are none left.
+        with self.condition:
+            worker.alive = False
+            worker.connection.close()
+            orphans = list(worker.queue)
+            worker.queue.clear()
+            live = [other for other in self.workers if other.alive]
+            for job in orphans:
+                if len(live) > 0:
+                    min(live, key=lambda other: len(other.queue)).queue.append(job)
+                else:
+                    job.future.set_exception(BuildError('No remote workers are available.'))
+            self.condition.notify_all()
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self.condition:
+            self.shutting_down = True
+            if cancel_futures:
+                for worker in self.workers:
+                    for job in worker.queue:
+                        job.future.cancel()
+                    worker.queue.clear()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        for worker in self.workers:
+            if worker.alive:
+                worker.connection.close()
+
+def startLocalWorker(directory: str) -> Tuple[subprocess.Popen, Address]:
+    # Starts a worker as a subprocess of this one, for tests and for using the cores of this machine.
+    environment = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join([package_parent] + [path for path in [environment.get('PYTHONPATH')] if path])
+    process = subprocess.Popen([sys.executable, '-m', 'pymake.remote', '--directory', directory],
+                               stdout=subprocess.PIPE, env=environment, text=True)
+    line = process.stdout.readline().split()
+    if len(line) != 3 or line[0] != 'listening':
+        process.kill()
+        raise BuildError('The remote worker did not start.')
+    return (process, (line[1], int(line[2])))
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Run a pymake remote worker.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--directory', required=True, help='Where uploaded files are kept and rules are run.')
+    args = parser.parse_args(argv)
+
+    def ready(address: Address) -> None:
+        print('listening %s %s' % address, flush=True)
+
+    RemoteWorker(os.path.abspath(args.directory)).serve(args.host, args.port, ready)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,33 @@
-from typing import Any
+from typing import Any, Callable, Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+from concurrent.futures import Future
+import functools
+import json
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import xml.etree.ElementTree as ElementTree
 from time import sleep
 
 if __name__ == "__main__":
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 
-from pymake import Build
-from pymake.filerules import FileTouchRule
-from pymake.builderrors import DuplicateRuleError, NoRuleError, CyclicGraphError, NoSettingError
+from pymake import Build, Profiler
+from pymake.Settings import Settings
+from pymake.PatternRule import PatternIndex, PatternRule
+from pymake.filerules import DirectoryRule, FileTouchRule, GenericFileRule, commandRecipe, parseDepfile
+from pymake.utilrules import PhoneyRule
+from pymake.filehash import FileHashCache, hashFile
+from pymake.filestat import StatCache, stat_cache
+from pymake.artifactcache import ArtifactCache, LocalArtifactCache, HttpArtifactCache
+from pymake.watcher import InotifyWatcher, PollingWatcher
+from pymake.remote import RemoteExecutor, _Job, startLocalWorker
+from pymake.builderrors import BuildError, DuplicateRuleError, NoRuleError, CyclicGraphError, NoSettingError
 
 def sortBuildTrace(build_tree):
     for build_step in build_tree:
@@ -302,8 +320,40 @@ class BuildThreeTestCase(unittest.TestCase):
         c = build.createRule('c.txt', FileTouchRule)
         c.addPrerequisite('a.txt')
 
-        with self.assertRaises(CyclicGraphError):
+        with self.assertRaises(CyclicGraphError) as context:
             build.build('a.txt')
+        self.assertListEqual(context.exception.cycle, ['a.txt', 'b.txt', 'c.txt', 'a.txt'])
+
+    def test_CyclicGraphError_SubCycle(self):
+
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+
+        b = build.createRule('b.txt', FileTouchRule)
+        b.addPrerequisite('c.txt')
+
+        c = build.createRule('c.txt', FileTouchRule)
+        c.addPrerequisite('b.txt')
+
+        with self.assertRaises(CyclicGraphError) as context:
+            build.build('a.txt')
+        self.assertListEqual(context.exception.cycle, ['b.txt', 'c.txt', 'b.txt'])
+
+    def test_LongChain(self):
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('step_0')
+        length = 20000
+        for i in range(length):
+            step = build.createRule('step_%s' % i, PhoneyRule)
+            if i < length-1:
+                step.addPrerequisite('step_%s' % (i+1))
+
+        build.build('a.txt')
+        self.assertEqual(len(build.trace), length+1)
+        self.assertListEqual(build.trace[0], ['step_%s' % (length-1)])
+        self.assertListEqual(build.trace[-1], ['a.txt'])
 
 class SettingsTestCase(unittest.TestCase):
     def tearDown(self):
@@ -470,6 +520,1635 @@ class MultipleTargetTestCase(unittest.TestCase):
         build.build('a.txt')
         self.assertListEqual(sortBuildTrace(build.trace), [['c.txt','d.txt'],['a.txt','b.txt']])
 
+class ParallelTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("c.txt")
+        removeIfExists("d.txt")
+
+    def test_Tree(self):
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        a.addPrerequisite('c.txt')
+
+        b = build.createRule('b.txt', FileTouchRule)
+        b.addPrerequisite('d.txt')
+
+        build.createRule('c.txt', FileTouchRule)
+        build.createRule('d.txt', FileTouchRule)
+
+        build.build('a.txt', jobs=4)
+        self.assertEqual(len(build.trace), 4)
+        order = [names[0] for names in build.trace]
+        self.assertLess(order.index('d.txt'), order.index('b.txt'))
+        self.assertEqual(order[-1], 'a.txt')
+        self.assertEqual(len(build.timings), 4)
+        for (names, start_time, end_time) in build.timings:
+            self.assertLessEqual(start_time, end_time)
+
+    def test_ProcessExecutor(self):
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        a.setExecutor('process')
+
+        b = build.createRule('b.txt', FileTouchRule)
+        b.setExecutor('process')
+
+        build.build('a.txt', jobs=2)
+        self.assertListEqual(build.trace, [['b.txt'], ['a.txt']])
+        self.assertTrue(os.path.exists('a.txt'))
+
+    def test_StopOnFailure(self):
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        a.addPrerequisite('c.txt')
+
+        build.createRule('b.txt')
+        build.createRule('c.txt', FileTouchRule)
+
+        with self.assertRaises(BuildError):
+            build.build('a.txt', jobs=2)
+        self.assertNotIn('a.txt', build.built_rules)
+        self.assertIn('b.txt', build.failed_rules)
+
+    def test_KeepGoing(self):
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        a.addPrerequisite('c.txt')
+
+        build.createRule('b.txt')
+        c = build.createRule('c.txt', FileTouchRule)
+        c.addPrerequisite('d.txt')
+        build.createRule('d.txt', FileTouchRule)
+
+        for jobs in [1, 2]:
+            with self.assertRaises(BuildError):
+                build.build('a.txt', jobs=jobs, keep_going=True)
+            self.assertSetEqual(build.failed_rules, {'b.txt'})
+            self.assertIn('c.txt', build.built_rules)
+            self.assertNotIn('a.txt', build.built_rules)
+            removeIfExists("c.txt")
+            removeIfExists("d.txt")
+
+class CountingTouchRule(FileTouchRule):
+    exists_calls = 0
+
+    def exists(self) -> bool:
+        CountingTouchRule.exists_calls += 1
+        return FileTouchRule.exists(self)
+
+class BuildStateTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("c.txt")
+        removeIfExists("state.db")
+
+    def createBuild(self, trust_recorded_outputs: bool = False) -> Build:
+        build = Build()
+        build.setStateFile('state.db', trust_recorded_outputs)
+        setSetting(build, 'a', 'a')
+        a = build.createRule('a.txt', CountingTouchRule)
+        a.addPrerequisite('b.txt')
+        a.addSetting('a')
+        build.createRule('b.txt', FileTouchRule)
+        build.createRule('c.txt', FileTouchRule)
+        return build
+
+    def test_NoOp(self):
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['a.txt']])
+
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+
+    def test_PrerequisiteAdded(self):
+        build = self.createBuild()
+        build.build('a.txt')
+        touchFile('c.txt')
+
+        build = self.createBuild()
+        build.rules['a.txt'].addPrerequisite('c.txt')
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+    def test_SettingChanged(self):
+        build = self.createBuild()
+        build.build('a.txt')
+
+        build = self.createBuild()
+        setSetting(build, 'a', 'changed')
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+
+    def test_TrustRecordedOutputs(self):
+        build = self.createBuild(True)
+        build.build('a.txt')
+
+        CountingTouchRule.exists_calls = 0
+        build = self.createBuild(True)
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+        self.assertEqual(CountingTouchRule.exists_calls, 0)
+
+    def test_TrustRecordedOutputsDeleted(self):
+        # b.txt needs a prerequisite for its recorded build time to be trusted.
+        def createBuild() -> Build:
+            build = self.createBuild(True)
+            build.rules['b.txt'].addPrerequisite('c.txt')
+            return build
+
+        createBuild().build('a.txt')
+
+        # Without a stat of b.txt the deletion goes unnoticed, prefetching the stats finds it.
+        os.remove('b.txt')
+        build = createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+
+        build = createBuild()
+        build.setStatPrefetch(True)
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['a.txt']])
+
+class ContentHashTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("state.db")
+
+    def createBuild(self) -> Build:
+        build = Build()
+        build.setStateFile('state.db', use_content_hashes=True)
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        build.createRule('b.txt', FileTouchRule)
+        return build
+
+    def writeNewer(self, path: str, content: str) -> None:
+        with open(path, 'w') as fle:
+            fle.write(content)
+        stat = os.stat('a.txt')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def test_TouchedUnchanged(self):
+        with open('b.txt', 'w') as fle:
+            fle.write('content')
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+        self.writeNewer('b.txt', 'content')
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+
+    def test_ContentChanged(self):
+        with open('b.txt', 'w') as fle:
+            fle.write('content')
+        build = self.createBuild()
+        build.build('a.txt')
+
+        self.writeNewer('b.txt', 'changed')
+        build = self.createBuild()
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+    def test_HashCache(self):
+        with open('b.txt', 'w') as fle:
+            fle.write('content')
+        stat = os.stat('b.txt')
+        os.utime('b.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**10))
+
+        stat_cache.clear()
+        cache = FileHashCache()
+        digest = cache.getHash('b.txt')
+        self.assertEqual(digest, hashFile('b.txt'))
+        self.assertIn('b.txt', cache.entries)
+
+        entry = cache.entries['b.txt']
+        cache.entries['b.txt'] = (*entry[:3], 'cached')
+        self.assertEqual(cache.getHash('b.txt'), 'cached')
+
+class StatCacheTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("c.txt")
+
+    def test_StatOnce(self):
+        touchFile('a.txt')
+        cache = StatCache()
+        self.assertTrue(cache.exists('a.txt'))
+        self.assertIsNotNone(cache.stat('a.txt'))
+        self.assertFalse(cache.exists('b.txt'))
+        self.assertFalse(cache.exists('b.txt'))
+        self.assertEqual(cache.stat_calls, 2)
+
+        touchFile('b.txt')
+        cache.invalidate(['b.txt'])
+        self.assertTrue(cache.exists('b.txt'))
+
+    def test_Prefetch(self):
+        touchFile('a.txt')
+        for threads in [1, 2]:
+            cache = StatCache()
+            cache.prefetch(['a.txt', 'b.txt', os.path.join('missing', 'c.txt')], threads)
+            self.assertEqual(cache.stat_calls, 1)
+            self.assertTrue(cache.exists('a.txt'))
+            self.assertFalse(cache.exists('b.txt'))
+            self.assertFalse(cache.exists(os.path.join('missing', 'c.txt')))
+            self.assertEqual(cache.stat_calls, 1)
+
+    def test_BuildPrefetch(self):
+        touchFile('c.txt')
+        build = Build()
+        build.setStatPrefetch(True)
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('b.txt')
+        a.addPrerequisite('c.txt')
+        b = build.createRule('b.txt', FileTouchRule)
+        b.addPrerequisite('c.txt')
+        build.createRule('c.txt', FileTouchRule)
+
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['a.txt']])
+        # Only c.txt exists, the missing targets are found from the directory listing.
+        self.assertEqual(build.stat_cache.stat_calls, 1)
+
+    def test_BuildsHaveTheirOwnCache(self):
+        touchFile('c.txt')
+        inner = Build()
+        inner.createRule('c.txt', FileTouchRule)
+
+        def buildInner(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+            # A build started from a recipe does not clear the stats of the build running it.
+            inner.build('c.txt')
+            touchFile(target)
+
+        build = Build()
+        a = build.createRule('a.txt', GenericFileRule)
+        a.addPrerequisite('c.txt')
+        a.setRecipe(buildInner)
+        build.createRule('c.txt', FileTouchRule)
+        build.build('a.txt')
+        self.assertIn('c.txt', build.stat_cache.stats)
+        self.assertNotIn('a.txt', inner.stat_cache.stats)
+        self.assertIn('c.txt', inner.stat_cache.stats)
+
+def writeRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    with open(target, 'w') as fle:
+        fle.write('%s from %s' % (settings_values['v'], ', '.join(prerequisites)))
+
+class CacheHandler(BaseHTTPRequestHandler):
+    blobs: Dict[str, bytes] = {}
+
+    def do_GET(self):
+        if self.path not in CacheHandler.blobs:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(CacheHandler.blobs[self.path])
+
+    def do_PUT(self):
+        CacheHandler.blobs[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def countingWriteRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    # The calls are logged to a file, as the globals a recipe uses are part of its cache key.
+    with open('recipe_calls.log', 'a') as fle:
+        fle.write(target + '\n')
+    writeRecipe(target, prerequisites, settings_values)
+
+def recipeCalls() -> int:
+    if not os.path.exists('recipe_calls.log'):
+        return 0
+    with open('recipe_calls.log') as fle:
+        return len(fle.readlines())
+
+recipe_flags = '-O0'
+
+def flagsRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    writeRecipe(target, prerequisites, {'v': recipe_flags})
+
+class ArtifactCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("recipe_calls.log")
+        shutil.rmtree(self.cache_dir)
+
+    def createBuild(self, cache: ArtifactCache, value: str = 'v') -> Build:
+        build = Build()
+        build.setArtifactCache(cache)
+        setSetting(build, 'v', value)
+        a = build.createRule('a.txt', GenericFileRule)
+        a.addPrerequisite('b.txt')
+        a.addSetting('v')
+        a.setRecipe(countingWriteRecipe)
+        build.createRule('b.txt', FileTouchRule)
+        return build
+
+    def checkRestore(self, cache: ArtifactCache) -> None:
+        self.createBuild(cache).build('a.txt')
+        self.assertEqual(recipeCalls(), 1)
+
+        removeIfExists('a.txt')
+        build = self.createBuild(cache)
+        build.build('a.txt', jobs=2)
+        self.assertEqual(recipeCalls(), 1)
+        with open('a.txt') as fle:
+            self.assertEqual(fle.read(), 'v from b.txt')
+
+        removeIfExists('a.txt')
+        self.createBuild(cache, 'w').build('a.txt')
+        self.assertEqual(recipeCalls(), 2)
+
+    def test_Local(self):
+        self.checkRestore(LocalArtifactCache(self.cache_dir))
+
+    def test_Http(self):
+        server = HTTPServer(('127.0.0.1', 0), CacheHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            self.checkRestore(HttpArtifactCache('http://127.0.0.1:%s/' % server.server_port))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_HttpUnreachable(self):
+        # Nothing listens on a port the OS picked for a socket that is then closed.
+        server = HTTPServer(('127.0.0.1', 0), CacheHandler)
+        port = server.server_port
+        server.server_close()
+        build = self.createBuild(HttpArtifactCache('http://127.0.0.1:%s/' % port, timeout=1))
+        with self.assertWarns(UserWarning):
+            build.build('a.txt')
+        self.assertEqual(recipeCalls(), 1)
+        with open('a.txt') as fle:
+            self.assertEqual(fle.read(), 'v from b.txt')
+
+    def test_RecipeIdentity(self):
+        def cacheKey(recipe: Callable) -> Optional[str]:
+            rule = GenericFileRule(['a.txt'])
+            rule.setRecipe(recipe)
+            return rule.getCacheKey({}, {})
+
+        self.assertNotEqual(cacheKey(commandRecipe(['cc', '-O0', '{prerequisites}'])),
+                            cacheKey(commandRecipe(['cc', '-O3', '{prerequisites}'])))
+        self.assertEqual(cacheKey(commandRecipe(['cc', '-O0', '{prerequisites}'])),
+                         cacheKey(commandRecipe(['cc', '-O0', '{prerequisites}'])))
+        self.assertNotEqual(cacheKey(functools.partial(writeRecipe, 'x')),
+                            cacheKey(functools.partial(writeRecipe, 'y')))
+        # The globals a recipe uses, and the functions it calls, are part of its identity.
+        global recipe_flags
+        key = cacheKey(flagsRecipe)
+        recipe_flags = '-O3'
+        self.assertNotEqual(cacheKey(flagsRecipe), key)
+        recipe_flags = '-O0'
+        self.assertEqual(cacheKey(flagsRecipe), key)
+        # A recipe closing over an object that cannot be identified is not cached.
+        self.assertIsNone(cacheKey(lambda target, prerequisites, settings_values: self))
+
+    def test_Incomplete(self):
+        class FetchOnlyCache(ArtifactCache):
+            def fetch(self, key: str) -> Optional[bytes]:
+                return None
+
+        with self.assertRaises(TypeError):
+            FetchOnlyCache()
+
+    def test_LocalEviction(self):
+        cache = LocalArtifactCache(self.cache_dir, max_size=25)
+        cache.store('aa01', b'x'*10)
+        cache.store('bb02', b'x'*10)
+        self.assertIsNotNone(cache.fetch('aa01'))
+        os.utime(cache._path('bb02'), ns=(0, 0))
+        cache.store('cc03', b'x'*10)
+        self.assertIsNotNone(cache.fetch('aa01'))
+        self.assertIsNone(cache.fetch('bb02'))
+        self.assertIsNotNone(cache.fetch('cc03'))
+        self.assertEqual(cache.total_size, 20)
+
+class MultipleBuildTargetsTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("c.txt")
+        removeIfExists("d.txt")
+
+    def createBuild(self) -> Build:
+        build = Build()
+        a = build.createRule('a.txt', FileTouchRule)
+        a.addPrerequisite('c.txt')
+        b = build.createRule('b.txt', FileTouchRule)
+        b.addPrerequisite('c.txt')
+        b.addPrerequisite('d.txt')
+        build.createRule('c.txt', FileTouchRule)
+        build.createRule('d.txt', FileTouchRule)
+        return build
+
+    def test_SharedPrerequisite(self):
+        build = self.createBuild()
+        build.build(['a.txt', 'b.txt'])
+        self.assertListEqual(sortBuildTrace(build.trace), [['c.txt', 'd.txt'], ['a.txt', 'b.txt']])
+
+    def test_SharedPrerequisiteParallel(self):
+        build = self.createBuild()
+        build.build(['a.txt', 'b.txt'], jobs=3)
+        order = [names[0] for names in build.trace]
+        self.assertEqual(sorted(order), ['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+
+    def test_TargetIsPrerequisite(self):
+        build = self.createBuild()
+        build.build(['c.txt', 'a.txt'])
+        self.assertListEqual(build.trace, [['c.txt'], ['a.txt']])
+
+class SleepRule(PhoneyRule):
+    def build(self, settings_values: Dict[str, Any]) -> None:
+        sleep(0.02 if self.names[0] == 'slow' else 0.001)
+
+class ProfilerTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("trace.json")
+
+    def test_CriticalPath(self):
+        build = Build()
+        profiler = Profiler()
+        build.setProfiler(profiler)
+        top = build.createRule('top', SleepRule)
+        top.addPrerequisite('slow')
+        top.addPrerequisite('fast')
+        slow = build.createRule('slow', SleepRule)
+        slow.addPrerequisite('bottom')
+        build.createRule('fast', SleepRule)
+        build.createRule('bottom', SleepRule)
+
+        build.build('top', jobs=2)
+        (path, length) = build.getCriticalPath()
+        self.assertListEqual(path, ['bottom', 'slow', 'top'])
+        self.assertGreaterEqual(length, 0.02)
+
+        phases = [name for (name, _, _) in profiler.phases]
+        self.assertIn('graph construction', phases)
+        self.assertIn('building', phases)
+        self.assertIn('stat calls', profiler.counters)
+        self.assertIn('scheduling time', profiler.counters)
+        self.assertEqual(len(profiler.rules), 4)
+
+        profiler.exportChromeTrace('trace.json')
+        with open('trace.json') as fle:
+            events = json.load(fle)['traceEvents']
+        self.assertSetEqual({event['name'] for event in events if event['cat'] == 'rule'}, {'top', 'slow', 'fast', 'bottom'})
+
+class PriorityTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("state.db")
+
+    def createBuild(self) -> Build:
+        build = Build()
+        top = build.createRule('top', PhoneyRule)
+        top.addPrerequisite('fast')
+        top.addPrerequisite('slow')
+        build.createRule('fast', PhoneyRule)
+        slow = build.createRule('slow', PhoneyRule)
+        slow.addPrerequisite('bottom')
+        build.createRule('bottom', PhoneyRule)
+        return build
+
+    def test_NoHistory(self):
+        build = self.createBuild()
+        build.build('top')
+        self.assertListEqual(build.trace, [['bottom', 'fast'], ['slow'], ['top']])
+
+    def test_LongestPathFirst(self):
+        build = self.createBuild()
+        build.durations = {'fast': 5.0, 'slow': 1.0, 'bottom': 1.0, 'top': 1.0}
+        build.build('top')
+        self.assertListEqual(build.trace, [['fast', 'bottom'], ['slow'], ['top']])
+
+        build.durations = {'fast': 1.0, 'slow': 5.0, 'bottom': 1.0, 'top': 1.0}
+        build.build('top')
+        self.assertListEqual(build.trace, [['bottom', 'fast'], ['slow'], ['top']])
+
+    def test_Recorded(self):
+        build = self.createBuild()
+        build.setStateFile('state.db')
+        build.build('top')
+        build.state.close()
+
+        build = self.createBuild()
+        build.setStateFile('state.db')
+        self.assertSetEqual(set(build.state.durations), {'top', 'fast', 'slow', 'bottom'})
+
+class AsyncBuildTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("b.txt")
+        removeIfExists("c.txt")
+
+    def test_CommandRecipe(self):
+        build = Build()
+        setSetting(build, 'text', 'hello')
+        a = build.createRule('a.txt', GenericFileRule)
+        a.addPrerequisite('b.txt')
+        a.addPrerequisite('c.txt')
+        a.addSetting('text')
+        a.setRecipe(commandRecipe([sys.executable, '-c', 'import sys; open(sys.argv[1], "w").write("{text}")', '{target}']))
+        build.createRule('b.txt', FileTouchRule)
+        build.createRule('c.txt', FileTouchRule)
+
+        asyncio.run(build.buildAsync('a.txt', jobs=2))
+        self.assertListEqual(sorted(build.trace[:2]), [['b.txt'], ['c.txt']])
+        self.assertListEqual(build.trace[2], ['a.txt'])
+        with open('a.txt') as fle:
+            self.assertEqual(fle.read(), 'hello')
+
+    def test_ConcurrencyLimit(self):
+        running = []
+        peak = []
+
+        async def recipe(target, prerequisites, settings_values):
+            running.append(target)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(target)
+            touchFile(target)
+
+        build = Build()
+        top = build.createRule('top', PhoneyRule)
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            rule = build.createRule(name, GenericFileRule)
+            rule.setRecipe(recipe)
+            top.addPrerequisite(rule)
+
+        asyncio.run(build.buildAsync('top', jobs=2))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(build.trace), 4)
+
+    def test_CancelOnFailure(self):
+        build = Build()
+        top = build.createRule('top', PhoneyRule)
+        slow = build.createRule('a.txt', GenericFileRule)
+        slow.setRecipe(commandRecipe([sys.executable, '-c', 'import time; time.sleep(30)']))
+        top.addPrerequisite(slow)
+        top.addPrerequisite(build.createRule('b.txt'))
+
+        start_time = time.perf_counter()
+        with self.assertRaises(BuildError):
+            asyncio.run(build.buildAsync('top', jobs=2))
+        self.assertLess(time.perf_counter() - start_time, 10)
+        self.assertSetEqual(build.failed_rules, {'b.txt'})
+        self.assertNotIn('a.txt', build.built_rules)
+
+class CountingRule(PhoneyRule):
+    lock = threading.Lock()
+    running: List[str] = []
+    peaks: List[List[str]] = []
+
+    def build(self, settings_values: Dict[str, Any]) -> None:
+        with CountingRule.lock:
+            CountingRule.running.append(self.names[0])
+            CountingRule.peaks.append(list(CountingRule.running))
+        sleep(0.02)
+        with CountingRule.lock:
+            CountingRule.running.remove(self.names[0])
+
+class ResourceTestCase(unittest.TestCase):
+    def setUp(self):
+        CountingRule.running = []
+        CountingRule.peaks = []
+
+    def test_Capacity(self):
+        build = Build()
+        build.setResourceCapacity('memory', 16)
+        top = build.createRule('top', PhoneyRule)
+        for i in range(4):
+            link = build.createRule('link%s' % i, CountingRule)
+            link.setResource('memory', 8)
+            top.addPrerequisite(link)
+
+        build.build('top', jobs=4)
+        self.assertEqual(max([len(running) for running in CountingRule.peaks]), 2)
+        self.assertEqual(len(build.trace), 5)
+
+    def test_LightRulesFillIn(self):
+        build = Build()
+        build.setResourceCapacity('memory', 8)
+        top = build.createRule('top', PhoneyRule)
+        for i in range(2):
+            link = build.createRule('link%s' % i, CountingRule)
+            link.setResource('memory', 8)
+            top.addPrerequisite(link)
+        for i in range(3):
+            top.addPrerequisite(build.createRule('compile%s' % i, CountingRule))
+
+        build.build('top', jobs=4)
+        for running in CountingRule.peaks:
+            self.assertLessEqual(len([name for name in running if name.startswith('link')]), 1)
+        self.assertEqual(max([len(running) for running in CountingRule.peaks]), 4)
+
+    def test_MixedAmounts(self):
+        build = Build()
+        build.setResourceCapacity('memory', 8)
+        top = build.createRule('top', PhoneyRule)
+        amounts = {}
+        for i in range(12):
+            rule = build.createRule('rule%s' % i, CountingRule)
+            amounts['rule%s' % i] = [6, 2, 4][i % 3]
+            rule.setResource('memory', amounts['rule%s' % i])
+            top.addPrerequisite(rule)
+
+        build.build('top', jobs=4)
+        self.assertEqual(len(build.trace), 13)
+        for running in CountingRule.peaks:
+            self.assertLessEqual(sum([amounts[name] for name in running]), 8)
+        self.assertIn(2, [len(running) for running in CountingRule.peaks])
+
+    def test_OversizedRuleRunsAlone(self):
+        build = Build()
+        build.setResourceCapacity('memory', 8)
+        top = build.createRule('top', PhoneyRule)
+        huge = build.createRule('huge', CountingRule)
+        huge.setResource('memory', 32)
+        top.addPrerequisite(huge)
+        top.addPrerequisite(build.createRule('small', CountingRule))
+
+        asyncio.run(build.buildAsync('top', jobs=4))
+        self.assertIn(['huge'], CountingRule.peaks)
+        self.assertNotIn(['small', 'huge'], CountingRule.peaks)
+        self.assertEqual(len(build.trace), 3)
+
+class WatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        for name in ['a.txt', 'b.txt', 'header.txt']:
+            removeIfExists(name)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def checkWatcher(self, watcher: Any) -> None:
+        try:
+            self.assertSetEqual(watcher.wait(0.05), set())
+            touchFile(self.path('b.txt'))
+            changed = set()
+            deadline = time.monotonic() + 5
+            while 'b.txt' not in {os.path.basename(name) for name in changed} and time.monotonic() < deadline:
+                changed.update(watcher.wait(0.1))
+            self.assertIn(self.path('b.txt'), changed)
+            self.assertNotIn(self.path('a.txt'), changed)
+        finally:
+            watcher.close()
+
+    def test_PollingWatcher(self):
+        touchFile(self.path('a.txt'))
+        self.checkWatcher(PollingWatcher([self.path('a.txt'), self.path('b.txt')], 0.01))
+
+    def test_InotifyWatcher(self):
+        touchFile(self.path('a.txt'))
+        try:
+            watcher = InotifyWatcher([self.path('a.txt'), self.path('b.txt')])
+        except (OSError, AttributeError):
+            self.skipTest('inotify is not available.')
+        self.checkWatcher(watcher)
+
+    def test_WatchDirectory(self):
+        watchers = [PollingWatcher([self.path('')], 0.01)]
+        try:
+            watchers.append(InotifyWatcher([self.path('')]))
+        except (OSError, AttributeError):
+            pass
+        try:
+            touchFile(self.path('new.txt'))
+            for watcher in watchers:
+                changed = set()
+                deadline = time.monotonic() + 5
+                while len(changed) == 0 and time.monotonic() < deadline:
+                    changed.update(watcher.wait(0.1))
+                self.assertSetEqual(changed, {self.path('')})
+        finally:
+            for watcher in watchers:
+                watcher.close()
+
+    def test_IncrementalRebuild(self):
+        a_path = self.path('a.txt')
+        b_path = self.path('b.txt')
+        c_path = self.path('c.txt')
+        d_path = self.path('d.txt')
+        touchFile(b_path)
+        touchFile(d_path)
+
+        build = Build()
+        a = build.createRule(a_path, FileTouchRule)
+        a.addPrerequisite(b_path)
+        build.createRule(b_path, FileTouchRule)
+        c = build.createRule(c_path, FileTouchRule)
+        c.addPrerequisite(d_path)
+        build.createRule(d_path, FileTouchRule)
+
+        traces = []
+        build_serial = build._buildSerial
+        def recordingBuildSerial(keep_going):
+            build_serial(keep_going)
+            traces.append(build.trace)
+            if len(traces) == 1:
+                stat = os.stat(a_path)
+                os.utime(b_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        build._buildSerial = recordingBuildSerial
+
+        thread = threading.Thread(target=lambda: build.watch([a_path, c_path], max_builds=2, watcher=PollingWatcher(build.rules.keys(), 0.01)))
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(traces), 2)
+        self.assertListEqual(sorted(traces[0][0]), [a_path, c_path])
+        self.assertListEqual(traces[1], [[a_path]])
+
+    def test_DiscoveredDependency(self):
+        # header.txt is only known once the first build has read it, and is edited after that.
+        def editHeader():
+            with open('header.txt', 'w') as fle:
+                fle.write('edited')
+            now = time.time_ns()
+            os.utime('header.txt', ns=(now, now + 10**9))
+
+        touchFile('header.txt')
+        build = Build()
+        a = build.createRule('a.txt', GenericFileRule)
+        a.addPrerequisite('b.txt')
+        a.setRecipe(writeReading)
+        build.createRule('b.txt', FileTouchRule)
+
+        traces = []
+        build_serial = build._buildSerial
+        def recordingBuildSerial(keep_going):
+            build_serial(keep_going)
+            traces.append(build.trace)
+            if len(traces) == 1:
+                threading.Timer(0.5, editHeader).start()
+        build._buildSerial = recordingBuildSerial
+
+        thread = threading.Thread(target=lambda: build.watch('a.txt', max_builds=2, poll_interval=0.01))
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertListEqual(traces, [[['b.txt'], ['a.txt']], [['a.txt']]])
+        with open('a.txt') as fle:
+            self.assertEqual(fle.read(), 'edited')
+
+class BuildGraphTestCase(unittest.TestCase):
+    def test_BuildTreeView(self):
+        build = Build()
+        top = build.createRule('top', PhoneyRule)
+        top.addPrerequisite('a')
+        top.addPrerequisite('b')
+        build.createRule(['a', 'b'], PhoneyRule)
+        build.createRule('unused', PhoneyRule)
+        build.build('top')
+
+        self.assertSetEqual(set(build.build_tree), {'top', 'a', 'b'})
+        self.assertEqual(len(build.graph), 2)
+        self.assertListEqual(list(build.graph.prerequisites(build.graph.ids['top'])), [build.graph.ids['a']])
+        self.assertSetEqual(build.build_tree['top']['prerequisites'], {'a', 'b'})
+        self.assertTrue(build.build_tree['a']['needs_to_build'])
+        self.assertNotIn('unused', build.build_tree)
+        self.assertSetEqual(set(build.built_rules), {'top', 'a', 'b'})
+
+    def test_DeepChain(self):
+        build = Build()
+        for i in range(1, 5000):
+            build.createRule('rule%s' % i, PhoneyRule).addPrerequisite('rule%s' % (i-1))
+        build.createRule('rule0', PhoneyRule)
+        build.build('rule4999')
+        self.assertEqual(len(build.trace), 5000)
+        self.assertListEqual(build.trace[0], ['rule0'])
+
+def writeReading(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> List[str]:
+    with open('header.txt') as fle:
+        content = fle.read()
+    with open(target, 'w') as fle:
+        fle.write(content)
+    return ['header.txt']
+
+def writeDepfile(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    with open(target, 'w') as fle:
+        fle.write('')
+    with open('a.d', 'w') as fle:
+        fle.write('%s: b.txt \\\n header.txt\n' % target)
+
+class DiscoveredDependencyTestCase(unittest.TestCase):
+    def setUp(self):
+        touchFile('header.txt')
+
+    def tearDown(self):
+        for name in ['a.txt', 'b.txt', 'a.d', 'header.txt', 'state.db']:
+            removeIfExists(name)
+
+    def createBuild(self, recipe: Callable, depfile: Optional[str] = None) -> Build:
+        build = Build()
+        build.setStateFile('state.db')
+        a = build.createRule('a.txt', GenericFileRule)
+        a.addPrerequisite('b.txt')
+        a.setRecipe(recipe)
+        a.setDepfile(depfile)
+        build.createRule('b.txt', FileTouchRule)
+        return build
+
+    def test_ParseDepfile(self):
+        self.assertListEqual(parseDepfile('a.o: a.c b.h \\\n  c\\ d.h $$e.h\nb.h:\n'), ['a.c', 'b.h', 'c d.h', '$e.h'])
+
+    def test_Returned(self):
+        build = self.createBuild(writeReading)
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['a.txt']])
+        build.state.close()
+
+        build = self.createBuild(writeReading)
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+        self.assertIn('header.txt', build.build_tree)
+        build.state.close()
+
+        os.utime('header.txt')
+        build = self.createBuild(writeReading)
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+    def test_Depfile(self):
+        build = self.createBuild(writeDepfile, 'a.d')
+        build.build('a.txt')
+        self.assertDictEqual(build.state.discovered, {'a.txt': ['header.txt']})
+        build.state.close()
+
+        os.utime('header.txt')
+        build = self.createBuild(writeDepfile, 'a.d')
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+    def test_ArtifactCache(self):
+        # A restored output has to match the content of the discovered header, not just b.txt.
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for content in ['one', 'two']:
+                with open('header.txt', 'w') as fle:
+                    fle.write(content)
+                sleep(2e-3)
+                build = self.createBuild(writeReading)
+                build.setArtifactCache(LocalArtifactCache(cache_dir))
+                build.build('a.txt')
+                build.state.close()
+                with open('a.txt') as fle:
+                    self.assertEqual(fle.read(), content)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_CriticalPath(self):
+        build = self.createBuild(writeReading)
+        build.build('a.txt')
+        build.state.close()
+
+        os.utime('header.txt')
+        build = self.createBuild(writeReading)
+        build.setProfiler(Profiler())
+        build.build('a.txt')
+        (path, _) = build.getCriticalPath()
+        self.assertEqual(path[-1], 'a.txt')
+        self.assertIn(path[0], ['b.txt', 'header.txt'])
+
+    def test_DiscoveredRemoved(self):
+        build = self.createBuild(writeDepfile, 'a.d')
+        build.build('a.txt')
+        build.state.close()
+
+        os.remove('header.txt')
+        build = self.createBuild(writeDepfile, 'a.d')
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [['a.txt']])
+
+def copyRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    with open(prerequisites[0]) as fle:
+        content = fle.read()
+    with open(target, 'w') as fle:
+        fle.write(content)
+
+def stripRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    with open(prerequisites[0]) as fle:
+        content = fle.read()
+    with open(target, 'w') as fle:
+        fle.write(content.strip())
+
+class EarlyCutoffTestCase(unittest.TestCase):
+    def setUp(self):
+        with open('a.txt', 'w') as fle:
+            fle.write('a')
+
+    def tearDown(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'state.db']:
+            removeIfExists(name)
+
+    def createBuild(self, early_cutoff: bool = True) -> Build:
+        build = Build()
+        build.setStateFile('state.db', early_cutoff=early_cutoff)
+        build.createRule('a.txt', FileTouchRule)
+        b = build.createRule('b.txt', GenericFileRule)
+        b.addPrerequisite('a.txt')
+        b.setRecipe(stripRecipe)
+        c = build.createRule('c.txt', GenericFileRule)
+        c.addPrerequisite('b.txt')
+        c.setRecipe(copyRecipe)
+        return build
+
+    def rewriteSource(self, content: str) -> None:
+        sleep(2e-3)
+        with open('a.txt', 'w') as fle:
+            fle.write(content)
+
+    def test_Unchanged(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+
+        self.rewriteSource('a\n')
+        build.build('c.txt')
+        self.assertListEqual(build.trace, [['b.txt']])
+        self.assertListEqual(build.skipped_rules, ['c.txt'])
+        build.state.close()
+
+        build = self.createBuild()
+        build.build('c.txt')
+        self.assertListEqual(build.trace, [])
+
+    def test_Changed(self):
+        build = self.createBuild()
+        build.build('c.txt')
+
+        self.rewriteSource('changed')
+        build.build('c.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+        self.assertListEqual(build.skipped_rules, [])
+        with open('c.txt') as fle:
+            self.assertEqual(fle.read(), 'changed')
+
+    def test_Disabled(self):
+        build = self.createBuild(False)
+        build.build('c.txt')
+
+        self.rewriteSource('a\n')
+        build.build('c.txt')
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+
+def sleepAndGetPid(rule: PhoneyRule) -> int:
+    sleep(0.2)
+    return os.getpid()
+
+class RemoteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.workers = [startLocalWorker(os.path.join(self.directory, str(i))) for i in range(2)]
+        self.executor = RemoteExecutor([address for (_, address) in self.workers])
+        with open('a.txt', 'w') as fle:
+            fle.write('a')
+
+    def tearDown(self):
+        self.executor.shutdown()
+        for (process, _) in self.workers:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+        shutil.rmtree(self.directory)
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt']:
+            removeIfExists(name)
+
+    def test_Build(self):
+        build = Build()
+        build.addExecutor('remote', self.executor)
+        build.createRule('a.txt', FileTouchRule)
+        for name, prerequisite in [('b.txt', 'a.txt'), ('c.txt', 'a.txt'), ('d.txt', 'a.txt'), ('e.txt', 'b.txt')]:
+            rule = build.createRule(name, GenericFileRule)
+            rule.addPrerequisite(prerequisite)
+            rule.setRecipe(copyRecipe)
+            rule.setExecutor('remote')
+        build.build(['c.txt', 'd.txt', 'e.txt'], 4)
+
+        self.assertSetEqual(set(build.built_rules), {'a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt'})
+        for name in ['b.txt', 'c.txt', 'd.txt', 'e.txt']:
+            with open(name) as fle:
+                self.assertEqual(fle.read(), 'a')
+        # a.txt and b.txt have the same content, so at most one upload per worker.
+        self.assertLessEqual(self.executor.uploads, 2)
+
+    def test_ChangedSource(self):
+        # The sources are older than the racy window, so their hashes are kept between builds. With
+        # one worker the second build's input is not uploaded again if its digest is stale.
+        self.workers.append(startLocalWorker(os.path.join(self.directory, 'single')))
+        executor = RemoteExecutor([self.workers[-1][1]])
+        try:
+            now = time.time_ns()
+            for (content, source_time) in [('one', now - 100 * 10**9), ('two', now - 50 * 10**9)]:
+                with open('a.txt', 'w') as fle:
+                    fle.write(content)
+                os.utime('a.txt', ns=(source_time, source_time))
+                if os.path.exists('b.txt'):
+                    os.utime('b.txt', ns=(source_time - 10**9, source_time - 10**9))
+                build = Build()
+                build.addExecutor('remote', executor)
+                build.createRule('a.txt', FileTouchRule)
+                rule = build.createRule('b.txt', GenericFileRule)
+                rule.addPrerequisite('a.txt')
+                rule.setRecipe(copyRecipe)
+                rule.setExecutor('remote')
+                build.build('b.txt', 2)
+                with open('b.txt') as fle:
+                    self.assertEqual(fle.read(), content)
+        finally:
+            executor.shutdown()
+
+    def test_Failure(self):
+        build = Build()
+        build.addExecutor('remote', self.executor)
+        rule = build.createRule('b.txt', GenericFileRule)
+        rule.addPrerequisite('missing.txt')
+        rule.setRecipe(copyRecipe)
+        rule.setExecutor('remote')
+        build.createRule('missing.txt', PhoneyRule)
+        with self.assertRaises(FileNotFoundError):
+            build.build('b.txt', 2)
+        self.assertNotIn('b.txt', build.built_rules)
+
+    def test_WorkStealing(self):
+        # Every job is queued on the first worker, so the second only gets work by stealing it.
+        jobs = []
+        with self.executor.condition:
+            for i in range(4):
+                jobs.append(_Job(Future(), sleepAndGetPid, (PhoneyRule(['r%s' % i]),)))
+                self.executor.workers[0].queue.append(jobs[-1])
+            self.executor.condition.notify_all()
+        pids = {job.future.result(timeout=30) for job in jobs}
+        self.assertSetEqual(pids, {process.pid for (process, _) in self.workers})
+
+class SettingsFingerprintTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("a.txt")
+        removeIfExists("settings.json")
+
+    def test_Fingerprint(self):
+        settings = Settings()
+        settings.setValue('a', [1, 2])
+        settings.setValue('b', {'x': 1})
+        fingerprint = settings.getFingerprint(['a', 'b'])
+        self.assertEqual(settings.getFingerprint(['b', 'a']), fingerprint)
+
+        settings.setValue('a', (1, 2))
+        self.assertEqual(settings.getFingerprint(['a', 'b']), fingerprint)
+
+        settings.setValue('a', [2, 1])
+        self.assertNotEqual(settings.getFingerprint(['a', 'b']), fingerprint)
+        self.assertEqual(settings.getLastBuildTimeForNames(['a', 'b']), settings.getLastBuildTime('a'))
+
+    def test_ReloadUnchanged(self):
+        build = Build()
+        setSetting(build, 'a', (1, 2))
+        build.saveSettings('settings.json')
+        date = build.settings.getLastBuildTime('a')
+
+        build = Build()
+        build.loadSettings('settings.json')
+        setSetting(build, 'a', (1, 2))
+        self.assertEqual(build.settings.getLastBuildTime('a'), date)
+
+        touchFile('a.txt')
+        build.createRule('a.txt', FileTouchRule).addSetting('a')
+        build.build('a.txt')
+        self.assertListEqual(build.trace, [])
+
+class BinarySettingsTestCase(unittest.TestCase):
+    def tearDown(self):
+        removeIfExists("settings.bin")
+        removeIfExists("settings.json")
+        removeIfExists("build.settings")
+
+    def createSettings(self) -> Settings:
+        settings = Settings()
+        settings.setValue('a', list(range(1000)))
+        settings.setValue('b', {'x': (1, 2)})
+        settings.setValue('c', 'c')
+        return settings
+
+    def test_RoundTrip(self):
+        settings = self.createSettings()
+        settings.serialise('settings.bin', binary=True)
+
+        loaded = Settings()
+        loaded.deserialise('settings.bin')
+        self.assertDictEqual(loaded.values, {})
+        self.assertDictEqual(loaded.getValuesForNames(['b']), {'b': {'x': (1, 2)}})
+        self.assertSetEqual(set(loaded.values), {'b'})
+        self.assertEqual(loaded.getFingerprint(['a', 'b', 'c']), settings.getFingerprint(['a', 'b', 'c']))
+        self.assertEqual(loaded.getLastBuildTime('a'), settings.getLastBuildTime('a'))
+        self.assertListEqual(loaded.getSettingValue('a'), list(range(1000)))
+
+    def test_Incremental(self):
+        settings = self.createSettings()
+        settings.serialise('settings.bin', binary=True)
+        size = os.path.getsize('settings.bin')
+
+        settings.setValue('c', 'changed')
+        settings.serialise('settings.bin', binary=True)
+        # Only the new value and the index were appended.
+        self.assertLess(os.path.getsize('settings.bin') - size, 200)
+
+        loaded = Settings()
+        loaded.deserialise('settings.bin')
+        self.assertDictEqual(loaded.getValuesForNames(['a', 'c']), {'a': list(range(1000)), 'c': 'changed'})
+
+    def test_InterruptedSave(self):
+        settings = self.createSettings()
+        settings.serialise('settings.bin', binary=True)
+        with open('settings.bin', 'ab') as fle:
+            fle.write(b'partial save')
+
+        loaded = Settings()
+        loaded.deserialise('settings.bin')
+        self.assertEqual(loaded.getSettingValue('c'), 'c')
+        loaded.setValue('c', 'changed')
+        loaded.serialise('settings.bin', binary=True)
+        loaded.deserialise('settings.bin')
+        self.assertEqual(loaded.getSettingValue('c'), 'changed')
+
+    def test_Json(self):
+        settings = self.createSettings()
+        settings.serialise('settings.json')
+        # Json unless binary is asked for, whatever the extension.
+        settings.serialise('build.settings')
+        with open('build.settings') as fle:
+            self.assertDictEqual(json.load(fle)['fingerprints'], settings.fingerprints)
+        loaded = Settings()
+        loaded.deserialise('settings.json')
+        self.assertEqual(loaded.getSettingValue('c'), 'c')
+        self.assertEqual(loaded.getFingerprint(['b']), settings.getFingerprint(['b']))
+
+class PatternRuleTestCase(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('pattern_src', exist_ok=True)
+        os.makedirs('pattern_build', exist_ok=True)
+        for name in ['a.c', 'b.c', 'c.cpp']:
+            with open(os.path.join('pattern_src', name), 'w') as fle:
+                fle.write(name)
+
+    def tearDown(self):
+        shutil.rmtree('pattern_src')
+        shutil.rmtree('pattern_build')
+
+    def createBuild(self) -> Build:
+        build = Build()
+        build.createPatternRule('pattern_src/%', FileTouchRule)
+        for source in ['pattern_src/%.c', 'pattern_src/%.cpp']:
+            compile_rule = build.createPatternRule('pattern_build/%.o', GenericFileRule, lambda rule, stem: rule.setRecipe(copyRecipe))
+            compile_rule.addPrerequisite(source)
+        everything = build.createRule('all', PhoneyRule)
+        everything.addPrerequisite('pattern_build/a.o')
+        everything.addPrerequisite('pattern_build/c.o')
+        return build
+
+    def test_Materialised(self):
+        build = self.createBuild()
+        build.build('all')
+        self.assertListEqual(sortBuildTrace(build.trace), [['pattern_build/a.o', 'pattern_build/c.o'], ['all']])
+        with open('pattern_build/c.o') as fle:
+            self.assertEqual(fle.read(), 'c.cpp')
+        self.assertListEqual(build.rules['pattern_build/a.o'].getPrerequisites(), ['pattern_src/a.c'])
+        self.assertNotIn('pattern_build/b.o', build.rules)
+
+        build.build('all')
+        self.assertListEqual(build.trace, [['all']])
+
+    def test_NoMatch(self):
+        build = self.createBuild()
+        with self.assertRaises(NoRuleError):
+            build.build('pattern_build/a.exe')
+
+    def test_NoMatchCanBeMade(self):
+        # Both pattern rules match d.o, but neither d.c nor d.cpp exists.
+        build = self.createBuild()
+        with self.assertRaises(NoRuleError):
+            build.build('pattern_build/d.o')
+        self.assertNotIn('pattern_build/d.o', build.rules)
+        self.assertFalse(os.path.exists('pattern_src/d.c'))
+
+    def test_ShortestStem(self):
+        index = PatternIndex()
+        index.add(PatternRule(['%.o']))
+        index.add(PatternRule(['pattern_build/%.o']))
+        index.add(PatternRule(['%.c']))
+        self.assertListEqual([stem for (stem, _) in index.match('pattern_build/a.o')], ['a', 'pattern_build/a'])
+        self.assertListEqual(index.match('a.h'), [])
+
+class GraphExportTestCase(unittest.TestCase):
+    def tearDown(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'graph.dot', 'graph.json', 'graph.graphml']:
+            removeIfExists(name)
+
+    def createBuild(self) -> Build:
+        # d.txt <- c.txt <- b.txt <- a.txt, with d.txt up to date.
+        touchFile('d.txt')
+        build = Build()
+        build.createRule('d.txt', FileTouchRule)
+        for name, prerequisite in [('c.txt', 'd.txt'), ('b.txt', 'c.txt'), ('a.txt', 'b.txt')]:
+            build.createRule(name, FileTouchRule).addPrerequisite(prerequisite)
+        return build
+
+    def readGraph(self) -> Dict[str, Any]:
+        with open('graph.json') as fle:
+            graph = json.load(fle)
+        names = {node['id']: node['name'] for node in graph['nodes']}
+        return {'nodes': sorted(names.values()), 'edges': sorted([(names[dep], names[node]) for (dep, node) in graph['edges']])}
+
+    def test_Dot(self):
+        build = self.createBuild()
+        build.setDotGraphOptions('graph.dot')
+        build.build('a.txt')
+        with open('graph.dot') as fle:
+            lines = fle.read().splitlines()
+        self.assertEqual(lines[0], 'digraph build_tree {')
+        self.assertEqual(len([line for line in lines if '[label=' in line]), 4)
+        self.assertEqual(len([line for line in lines if '->' in line]), 3)
+
+    def test_DirtyOnly(self):
+        build = self.createBuild()
+        build.setDotGraphOptions('graph.json', dirty_only=True)
+        build.build('a.txt')
+        self.assertDictEqual(self.readGraph(), {'nodes': ['a.txt', 'b.txt', 'c.txt'], 'edges': [('b.txt', 'a.txt'), ('c.txt', 'b.txt')]})
+
+    def test_Hops(self):
+        build = self.createBuild()
+        build.setDotGraphOptions('graph.json', targets=['b.txt'], hops=1)
+        build.build('a.txt')
+        self.assertDictEqual(self.readGraph(), {'nodes': ['b.txt', 'c.txt'], 'edges': [('c.txt', 'b.txt')]})
+
+    def test_CriticalPath(self):
+        build = self.createBuild()
+        build.createRule('e.txt', PhoneyRule)
+        build.rules['a.txt'].addPrerequisite('e.txt')
+        build.setDotGraphOptions('graph.json', critical_path=True)
+        build.build('a.txt')
+        self.assertListEqual(self.readGraph()['nodes'], ['a.txt', 'b.txt', 'c.txt'])
+
+    def test_GraphML(self):
+        build = self.createBuild()
+        build.setDotGraphOptions('graph.graphml')
+        build.build('a.txt')
+        root = ElementTree.parse('graph.graphml').getroot()
+        namespace = '{http://graphml.graphdrawing.org/xmlns}'
+        self.assertEqual(len(root.findall('.//%snode' % namespace)), 4)
+        self.assertEqual(len(root.findall('.//%sedge' % namespace)), 3)
+
+def writeThenFail(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    copyRecipe(target, prerequisites, settings_values)
+    raise BuildError('Failed after writing %s.' % target)
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        with open('a.txt', 'w') as fle:
+            fle.write('a')
+
+    def tearDown(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'state.db', 'build.journal']:
+            removeIfExists(name)
+
+    def createBuild(self, state: bool = False) -> Build:
+        build = Build()
+        if state:
+            build.setStateFile('state.db')
+        build.setJournal('build.journal')
+        build.createRule('a.txt', FileTouchRule)
+        b = build.createRule('b.txt', GenericFileRule)
+        b.addPrerequisite('a.txt')
+        b.setRecipe(copyRecipe)
+        c = build.createRule('c.txt', GenericFileRule)
+        c.addPrerequisite('b.txt')
+        c.setRecipe(copyRecipe)
+        return build
+
+    def test_Compacted(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+        self.assertEqual(os.path.getsize('build.journal'), 0)
+
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [])
+
+    def test_Interrupted(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        # A build that was killed while writing b.txt, leaving it newer than a.txt.
+        with open('build.journal', 'a') as fle:
+            fle.write(json.dumps({'event': 'start', 'name': 'b.txt'}) + '\n')
+            fle.write('{"event": "fin')
+
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+
+    def test_InterruptedOtherTarget(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        with open('build.journal', 'a') as fle:
+            fle.write(json.dumps({'event': 'start', 'name': 'c.txt'}) + '\n')
+
+        # A build of another target does not clear what the killed build left unfinished.
+        build = self.createBuild()
+        build.build('b.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [])
+
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [['c.txt']])
+
+    def test_Failed(self):
+        build = self.createBuild()
+        build.rules['b.txt'].setRecipe(writeThenFail)
+        with self.assertRaises(BuildError):
+            build.build('c.txt')
+        build.journal.close()
+
+        build = self.createBuild()
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [['b.txt'], ['c.txt']])
+
+    def test_Resumed(self):
+        build = self.createBuild(state=True)
+        # A build that is killed before it saves its state.
+        build._recordState = lambda: None
+        build.build('c.txt')
+        build.journal.close()
+        build.state.connection.close()
+
+        build = self.createBuild(state=True)
+        self.assertIsNone(build.state.getRecord('b.txt'))
+        build._resumeJournal()
+        self.assertEqual(build.state.getRecord('b.txt')[1], ['a.txt'])
+        self.assertEqual(build.state.getRecord('c.txt')[1], ['b.txt'])
+        build.build('c.txt')
+        build.journal.close()
+        self.assertListEqual(build.trace, [])
+
+class ExplainTestCase(unittest.TestCase):
+    def tearDown(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'state.db']:
+            removeIfExists(name)
+
+    def createBuild(self, state: bool = False, settings: Optional[Settings] = None) -> Build:
+        # c.txt <- b.txt <- a.txt, with a setting on b.txt that keeps its date between builds.
+        build = Build()
+        if state:
+            build.setStateFile('state.db')
+        if settings is not None:
+            build.settings = settings
+        setSetting(build, 's', 1)
+        build.createRule('a.txt', FileTouchRule)
+        b = build.createRule('b.txt', FileTouchRule)
+        b.addPrerequisite('a.txt')
+        b.addSetting('s')
+        build.createRule('c.txt', FileTouchRule).addPrerequisite('b.txt')
+        return build
+
+    def settle(self, build: Build) -> None:
+        # Orders the outputs after the setting explicitly, as file times can be coarser than the
+        # setting's date.
+        date = build.settings.getLastBuildTime('s')
+        for offset, name in enumerate(['a.txt', 'b.txt', 'c.txt']):
+            os.utime(name, ns=(date + 1000 * (offset + 1), date + 1000 * (offset + 1)))
+
+    def test_MissingOutput(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        self.assertEqual(build.explain('a.txt').kind, 'missing output')
+        self.assertListEqual([(name, reason.kind) for (name, reason) in build.explainChain('c.txt')],
+                             [('c.txt', 'missing output')])
+        with self.assertRaises(KeyError):
+            build.explain('d.txt')
+
+    def test_NewerPrerequisite(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        self.settle(build)
+        now = build.settings.getLastBuildTime('s') + 10000
+        os.utime('a.txt', ns=(now, now))
+
+        build = self.createBuild(settings=build.settings)
+        build.build('c.txt')
+        reason = build.explain('b.txt')
+        self.assertEqual(reason.kind, 'newer prerequisite')
+        self.assertEqual(reason.name, 'a.txt')
+        self.assertEqual(reason.time, now)
+        self.assertLess(reason.target_time, reason.time)
+        self.assertIsNone(build.explain('a.txt'))
+        self.assertListEqual([(name, reason.kind) for (name, reason) in build.explainChain('c.txt')],
+                             [('c.txt', 'prerequisite rebuilt'), ('b.txt', 'newer prerequisite')])
+        self.assertListEqual(build.explainReport().splitlines(),
+                             ['c.txt: prerequisite b.txt needs building, because b.txt: %s' % reason,
+                              'b.txt: %s' % reason])
+
+    def test_NewerSetting(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        self.settle(build)
+
+        build = self.createBuild(settings=build.settings)
+        setSetting(build, 's', 2)
+        build.build('c.txt')
+        reason = build.explain('b.txt')
+        self.assertEqual(reason.kind, 'newer setting')
+        self.assertEqual(reason.name, 's')
+        self.assertEqual(reason.time, build.settings.getLastBuildTime('s'))
+
+    def test_SettingsChanged(self):
+        build = self.createBuild(state=True)
+        build.build('c.txt')
+        self.settle(build)
+
+        build = self.createBuild(state=True, settings=build.settings)
+        setSetting(build, 's', 2)
+        build.build('c.txt')
+        self.assertEqual(build.explain('b.txt').kind, 'settings changed')
+        self.assertEqual(build.explain('b.txt').name, 's')
+
+    def test_UpToDate(self):
+        build = self.createBuild()
+        build.build('c.txt')
+        self.settle(build)
+
+        build = self.createBuild(settings=build.settings)
+        build.build('c.txt')
+        self.assertIsNone(build.explain('c.txt'))
+        self.assertEqual(build.explainReport(), '')
+
+def listRecipe(target: str, prerequisites: List[str], settings_values: Dict[str, Any]) -> None:
+    with open(target, 'w') as fle:
+        fle.write('\n'.join(sorted(os.listdir(prerequisites[0]))))
+
+class DirectoryRuleTestCase(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(os.path.join('assets', 'sub'))
+        for name in ['a.png', 'b.txt', os.path.join('sub', 'c.png')]:
+            touchFile(os.path.join('assets', name))
+
+    def tearDown(self):
+        shutil.rmtree('assets', ignore_errors=True)
+        for name in ['out.txt', 'txt.txt'] + [name for name in os.listdir('.') if name.startswith('.assets.')]:
+            removeIfExists(name)
+
+    def createBuild(self, pattern: Optional[str] = None) -> Build:
+        build = Build()
+        build.createRule('assets', DirectoryRule).setPattern(pattern)
+        out = build.createRule('out.txt', GenericFileRule)
+        out.addPrerequisite('assets')
+        out.setRecipe(listRecipe)
+        return build
+
+    def rebuild(self, pattern: Optional[str] = None) -> List[List[str]]:
+        build = self.createBuild(pattern)
+        build.build('out.txt')
+        return build.trace
+
+    def test_Unchanged(self):
+        self.assertListEqual(self.rebuild(), [['out.txt']])
+        self.assertListEqual(self.rebuild(), [])
+        build = self.createBuild('*.png')
+        self.assertListEqual(build.rules['assets'].getFiles(),
+                             [os.path.join('assets', 'a.png'), os.path.join('assets', 'sub/c.png')])
+
+    def test_FileModified(self):
+        self.rebuild()
+        now = time.time_ns()
+        os.utime(os.path.join('assets', 'sub', 'c.png'), ns=(now, now))
+        self.assertListEqual(self.rebuild(), [['out.txt']])
+        self.assertListEqual(self.rebuild(), [])
+
+    def test_ArtifactCache(self):
+        # The directory is hashed by its files, so an output listing it is restored until they change.
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for (removed, listing) in [(None, 'a.png\nb.txt\nsub'), ('out.txt', 'a.png\nb.txt\nsub'), (os.path.join('assets', 'b.txt'), 'a.png\nsub')]:
+                if removed is not None:
+                    os.remove(removed)
+                build = self.createBuild()
+                build.setArtifactCache(LocalArtifactCache(cache_dir))
+                build.build('out.txt')
+                with open('out.txt') as fle:
+                    self.assertEqual(fle.read(), listing)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_Watch(self):
+        # The file is edited once the first build is done and the watcher is waiting.
+        def editFile():
+            now = time.time_ns()
+            os.utime(os.path.join('assets', 'sub', 'c.png'), ns=(now, now + 10**9))
+
+        build = self.createBuild()
+        traces = []
+        build_serial = build._buildSerial
+        def recordingBuildSerial(keep_going):
+            build_serial(keep_going)
+            traces.append(build.trace)
+            if len(traces) == 1:
+                threading.Timer(0.5, editFile).start()
+        build._buildSerial = recordingBuildSerial
+
+        thread = threading.Thread(target=lambda: build.watch('out.txt', max_builds=2, poll_interval=0.01))
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertListEqual(traces, [[['out.txt']], [['out.txt']]])
+
+    def test_FileAddedAndRemoved(self):
+        self.rebuild()
+        touchFile(os.path.join('assets', 'sub', 'd.png'))
+        self.assertListEqual(self.rebuild(), [['out.txt']])
+        os.remove(os.path.join('assets', 'a.png'))
+        self.assertListEqual(self.rebuild(), [['out.txt']])
+
+    def test_PatternsOfOneDirectory(self):
+        def createBuild() -> Build:
+            build = self.createBuild('*.png')
+            build.createRule('./assets', DirectoryRule).setPattern('*.txt')
+            out = build.createRule('txt.txt', GenericFileRule)
+            out.addPrerequisite('./assets')
+            out.setRecipe(listRecipe)
+            return build
+
+        build = createBuild()
+        build.build(['out.txt', 'txt.txt'])
+        self.assertListEqual(sortBuildTrace(build.trace), [['out.txt', 'txt.txt']])
+        for _ in range(3):
+            build = createBuild()
+            build.build(['out.txt', 'txt.txt'])
+            self.assertListEqual(build.trace, [])
+
+    def test_Pattern(self):
+        self.rebuild('*.png')
+        touchFile(os.path.join('assets', 'sub', 'd.txt'))
+        self.assertListEqual(self.rebuild('*.png'), [])
+        touchFile(os.path.join('assets', 'sub', 'd.png'))
+        self.assertListEqual(self.rebuild('*.png'), [['out.txt']])
+
+    def test_UnchangedDirectoriesNotListed(self):
+        # Directories modified just before a scan are listed again on the next one.
+        sleep(0.1)
+        build = self.createBuild()
+        self.assertGreater(build.rules['assets'].getLastBuildTime(), 0)
+        self.assertEqual(build.rules['assets'].listed, 2)
+
+        stat_cache.clear()
+        build = self.createBuild()
+        changed = build.rules['assets'].getLastBuildTime()
+        self.assertEqual(build.rules['assets'].listed, 0)
+        touchFile(os.path.join('assets', 'sub', 'd.png'))
+
+        stat_cache.clear()
+        build = self.createBuild()
+        self.assertGreater(build.rules['assets'].getLastBuildTime(), changed)
+        self.assertEqual(build.rules['assets'].listed, 1)
+
 
 if __name__ == "__main__":
     unittest.main()
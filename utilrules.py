@@ -4,6 +4,8 @@ from typing import List, Dict, Any
 from pymake.BaseRule import BaseRule
 
 class PhoneyRule(BaseRule):
+    __slots__ = ()
+
     def __init__(self, names):
         BaseRule.__init__(self, names)
 
@@ -0,0 +1,140 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# A path that ends in a separator, such as 'assets/', watches the directory for a change to any of its entries.
+
+def _groupByDirectory(paths: Iterable[str]) -> Dict[str, Dict[str, List[str]]]:
+    # directory -> base name, or '' for any entry -> the paths as they were given
+    directories: Dict[str, Dict[str, List[str]]] = {}
+    for path in paths:
+        base_name = os.path.basename(path)
+        directory = os.path.dirname(path) or '.'
+        directories.setdefault(directory, {}).setdefault(base_name, []).append(path)
+    return directories
+
+class PollingWatcher:
+    def __init__(self, paths: Iterable[str], interval: float = 0.1):
+        self.interval = interval
+        self.directories: Dict[str, Dict[str, List[str]]] = {}
+        self.snapshot: Dict[str, Optional[Tuple]] = {}
+        self.add(paths)
+
+    def add(self, paths: Iterable[str]) -> None:
+        # Changes to the paths already watched are still reported by the next wait.
+        paths = [path for path in paths if path not in self.snapshot]
+        for directory, names in _groupByDirectory(paths).items():
+            for name, name_paths in names.items():
+                self.directories.setdefault(directory, {}).setdefault(name, []).extend(name_paths)
+        snapshot = self._scan()
+        for path in paths:
+            self.snapshot[path] = snapshot[path]
+
+    def _scan(self) -> Dict[str, Optional[Tuple]]:
+        # One directory listing per directory, only the watched entries are stat'ed, or all of them
+        # when the directory is watched as a whole.
+        snapshot: Dict[str, Optional[Tuple]] = {}
+        for directory, names in self.directories.items():
+            for paths in names.values():
+                for path in paths:
+                    snapshot[path] = None
+            watch_all = '' in names
+            entries = []
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name not in names and not watch_all:
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        for path in names.get(entry.name, []):
+                            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                        entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for path in names.get('', []):
+                snapshot[path] = tuple(sorted(entries))
+        return snapshot
+
+    def wait(self, timeout: float) -> Set[str]:
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = {path for path, state in snapshot.items() if self.snapshot.get(path) != state}
+            self.snapshot = snapshot
+            if len(changed) > 0 or time.monotonic() >= deadline:
+                return changed
+            time.sleep(min(self.interval, max(0.0, deadline - time.monotonic())))
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, paths: Iterable[str]):
+        # Directories are watched rather than files, so files that are replaced or created are seen too.
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.libc = libc
+        self.watches: Dict[int, Dict[str, List[str]]] = {}
+        self.add(paths)
+
+    def add(self, paths: Iterable[str]) -> None:
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        for directory, names in _groupByDirectory(paths).items():
+            # Adding a directory that is already watched gives its existing watch descriptor.
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd >= 0:
+                watched = self.watches.setdefault(wd, {})
+                for name, name_paths in names.items():
+                    watched_paths = watched.setdefault(name, [])
+                    watched_paths.extend([path for path in name_paths if path not in watched_paths])
+
+    def wait(self, timeout: float) -> Set[str]:
+        changed: Set[str] = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            names = self.watches.get(wd, {})
+            changed.update(names.get(name, []))
+            changed.update(names.get('', []))
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def createWatcher(paths: Iterable[str], interval: float = 0.1):
+    paths = list(paths)
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError):
+        return PollingWatcher(paths, interval)